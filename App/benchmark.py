@@ -0,0 +1,473 @@
+'''
+Benchmarks for the backend. Each one prints a small report.
+Run with: python3 benchmark.py [benchmark ...] (all of them by default)
+    startup   import-time profile of trial.py, as reported by
+              python -X importtime, and the time from a cold interpreter
+              to the first encoded frame
+    demos     size and random access time of demo action sequences in a
+              DemoStore against a dict of int lists
+    transitions
+              time and memory to record --steps transitions in a
+              TransitionBuffer against per-step arrays in lists
+    archive   size and load time of --steps transitions as indented JSON,
+              an episode archive directory and a compressed .npz
+    tiles     MountainCar tile coding with tiles() against TileCoder, one
+              state at a time and in batches, hashed and direct-indexed
+    tamer     TamerAgent.update_reward_function with dense credit arrays
+              against the sparse update, checking both give the same weights
+    window    trimming TAMER's experiences to the feedback window after
+              gaps without feedback, with list.pop(0) and an ExperienceBuffer
+    actions   action values, tie-breaking argmax, softmax gradient and trace
+              update of the agents per call, with the per-action loops they
+              replaced and vectorized, for 3 and 18 actions
+    coach     CoachAgent.update_policy with a dense trace against the sparse
+              one, mostly without feedback, checking both give the same weights
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+def import_profile(module):
+    '''
+    Imports module in a fresh interpreter with -X importtime.
+    Returns:
+        - rows (Type: list of (cumulative us, self us, module name), slowest first)
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{result.stderr[-2000:]}')
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(selfTime), name.strip()))
+    rows.sort(reverse=True)
+    return rows
+
+# run in a fresh interpreter so nothing is imported or cached yet
+FIRST_FRAME = '''
+import json, time
+start = time.perf_counter()
+import trial
+imported = time.perf_counter()
+from agent import Agent, load_demos
+from frameEncoder import encode_frame
+agent = Agent()
+agent.start({game!r})
+agent.reset()
+frame = encode_frame(agent.render())
+firstFrame = time.perf_counter()
+load_demos()
+demos = time.perf_counter()
+print(json.dumps({{'importTrial': imported - start, 'firstFrame': firstFrame - start,
+                  'loadDemos': demos - firstFrame}}))
+'''
+
+@benchmark
+def bench_startup(args):
+    rows = import_profile('trial')
+    total = next(cumulative for cumulative, _, name in rows if name == 'trial')
+    print(f'import trial: {total/1000:.1f} ms, slowest imports:')
+    print(f'  {"cumulative ms":>14} {"self ms":>8}  module')
+    for cumulative, selfTime, name in rows[:args.top]:
+        print(f'  {cumulative/1000:>14.1f} {selfTime/1000:>8.1f}  {name}')
+
+    result = subprocess.run([sys.executable, '-c', FIRST_FRAME.format(game=args.game)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f'first frame failed:\n{result.stderr[-2000:]}')
+        return
+    times = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f'cold start to first {args.game} frame: {times["firstFrame"]*1000:.1f} ms '
+          f'(import trial {times["importTrial"]*1000:.1f} ms), '
+          f'loading demos on demand: {times["loadDemos"]*1000:.1f} ms')
+
+def synthetic_demos(count, seed=0):
+    '''
+    Demos shaped like data/demos.json: 100-200 steps made of a few long
+    runs of actions 0 and 2.
+    '''
+    rng = np.random.default_rng(seed)
+    demos = {}
+    for demoId in range(1, count + 1):
+        steps = int(rng.integers(100, 201))
+        cuts = np.sort(rng.choice(np.arange(1, steps), size=3, replace=False))
+        actions = np.zeros(steps, dtype=np.int64)
+        for run, (start, end) in enumerate(zip(np.append(0, cuts), np.append(cuts, steps))):
+            actions[start:end] = 2*(run % 2)
+        demos[demoId] = actions.tolist()
+    return demos
+
+@benchmark
+def bench_demos(args):
+    from demoStore import DemoStore
+    demos = synthetic_demos(args.demos)
+    listBytes = sum(sys.getsizeof(actions) for actions in demos.values()) + sys.getsizeof(demos)
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        DemoStore.build(path, demos)
+        built = time.perf_counter() - start
+        store = DemoStore(path)
+        ids = np.random.default_rng(1).integers(1, args.demos + 1, size=10000).tolist()
+        start = time.perf_counter()
+        for demoId in ids:
+            len(demos[demoId])
+        dictTime = (time.perf_counter() - start)/len(ids)
+        start = time.perf_counter()
+        for demoId in ids:
+            len(store[demoId])
+        storeTime = (time.perf_counter() - start)/len(ids)
+        assert all(store[demoId].tolist() == demos[demoId] for demoId in ids[:100])
+        storeBytes = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    print(f'{args.demos} demos: dict of lists {listBytes/1024:.0f} KiB in every process, '
+          f'DemoStore {storeBytes/1024:.0f} KiB mapped (built in {built*1000:.0f} ms)')
+    print(f'random access: dict {dictTime*1e6:.2f} us, DemoStore {storeTime*1e6:.2f} us per demo')
+
+def record_lists(observations, actions, dones):
+    transition = {'obs': [], 'action': [], 'reward': [],'next_obs': [], 'dones': []}
+    for step in range(len(actions)):
+        transition['obs'].append(np.array(observations[step], dtype= np.float32))
+        transition['next_obs'].append(np.array(observations[step + 1], dtype= np.float32))
+        transition['reward'].append(-1.0)
+        transition['action'].append(actions[step])
+        transition['dones'].append(dones[step])
+    return transition
+
+def record_buffer(observations, actions, dones):
+    from transitionBuffer import TransitionBuffer
+    buffer = TransitionBuffer()
+    for step in range(len(actions)):
+        buffer.add(observations[step], actions[step], -1.0, observations[step + 1], dones[step])
+    return buffer
+
+def measure(record, *inputs):
+    '''
+    Returns:
+        - result (Type: whatever record returns)
+        - seconds (Type: float time to run record)
+        - bytes (Type: int memory held by the result, from a second run under tracemalloc)
+    '''
+    start = time.perf_counter()
+    result = record(*inputs)
+    seconds = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = record(*inputs)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, seconds, held
+
+@benchmark
+def bench_transitions(args):
+    rng = np.random.default_rng(0)
+    observations = list(rng.random((args.steps + 1, 2)))
+    actions = rng.integers(0, 3, size=args.steps).tolist()
+    # episodes of 200 steps, as in MountainCar
+    dones = [(step + 1) % 200 == 0 for step in range(args.steps)]
+    transition, listTime, listBytes = measure(record_lists, observations, actions, dones)
+    buffer, bufferTime, bufferBytes = measure(record_buffer, observations, actions, dones)
+    assert np.array_equal(buffer['next_obs'], np.array(transition['next_obs']))
+    print(f'{args.steps} steps: lists {listTime/args.steps*1e6:.2f} us/step, {listBytes/1024:.0f} KiB; '
+          f'TransitionBuffer {bufferTime/args.steps*1e6:.2f} us/step, {bufferBytes/1024:.0f} KiB '
+          f'({buffer.episodes()} episodes)')
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+@benchmark
+def bench_archive(args):
+    from episodeArchive import save_archive, load_archive
+    rng = np.random.default_rng(0)
+    observations = list(rng.random((args.steps + 1, 2)))
+    actions = rng.integers(0, 3, size=args.steps).tolist()
+    dones = [(step + 1) % 200 == 0 for step in range(args.steps)]
+    buffer = record_buffer(observations, actions, dones)
+    with tempfile.TemporaryDirectory() as path:
+        jsonFile = os.path.join(path, 'transitions.json')
+        start = time.perf_counter()
+        with open(jsonFile, 'w') as outfile:
+            json.dump({name: buffer[name].tolist() for name in buffer.keys()}, outfile, indent=2)
+        jsonSave = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(jsonFile) as infile:
+            json.load(infile)
+        jsonLoad = time.perf_counter() - start
+        print(f'{args.steps} steps: JSON {directory_size(jsonFile)/1024:.0f} KiB, '
+              f'saved in {jsonSave*1000:.0f} ms, loaded in {jsonLoad*1000:.0f} ms')
+        for name in ('episodes', 'episodes.npz'):
+            archive = os.path.join(path, name)
+            start = time.perf_counter()
+            save_archive(archive, buffer)
+            saved = time.perf_counter() - start
+            start = time.perf_counter()
+            loaded, _ = load_archive(archive)
+            loaded['next_obs']
+            loadTime = time.perf_counter() - start
+            assert np.array_equal(loaded['obs'], buffer['obs'])
+            print(f'  {name}: {directory_size(archive)/1024:.0f} KiB, saved in {saved*1000:.0f} ms, '
+                  f'loaded in {loadTime*1000:.0f} ms')
+
+def time_per_state(func, states, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(states)
+        best = min(best, time.perf_counter() - start)
+    return best/len(states)
+
+@benchmark
+def bench_tiles(args):
+    from tileCoding import IHT, tiles, MountainCarTileCoder
+    rng = np.random.default_rng(0)
+    states = np.column_stack((rng.uniform(-1.2, .6, args.states), rng.uniform(-.07, .07, args.states)))
+    iht = IHT(4096)
+    def legacy(states):
+        # the pure Python tile coding the agents used before
+        return [np.array(tiles(iht, 8, [((p + 1.2)/1.7)*8, ((v + .07)/.14)*8])) for p, v in states.tolist()]
+    hashed = MountainCarTileCoder()
+    direct = MountainCarTileCoder(direct=True)
+    assert np.array_equal(np.array(legacy(states)), hashed.get_tiles_batch(states))
+    # direct indices partition the states like the hashed ones, one to one
+    pairs = set(zip(hashed.get_tiles_batch(states).ravel().tolist(), direct.get_tiles_batch(states).ravel().tolist()))
+    assert len(pairs) == len({h for h, _ in pairs}) == len({d for _, d in pairs}), 'direct tiles differ from hashed'
+    results = [
+        ('tiles() with IHT', time_per_state(legacy, states)),
+        ('TileCoder hashed', time_per_state(lambda s: [hashed.get_tiles(p, v) for p, v in s.tolist()], states)),
+        ('TileCoder direct', time_per_state(lambda s: [direct.get_tiles(p, v) for p, v in s.tolist()], states)),
+        ('TileCoder hashed, batch', time_per_state(hashed.get_tiles_batch, states)),
+        ('TileCoder direct, batch', time_per_state(direct.get_tiles_batch, states)),
+    ]
+    print(f'{args.states} MountainCar states, 8 tilings of 8x8 tiles:')
+    for name, seconds in results:
+        print(f'  {name:<24} {seconds*1e6:8.2f} us per state')
+
+def dense_tamer_update(agent, r):
+    '''
+    The TAMER update as it was written before it was made sparse.
+    '''
+    weight_per_experience = 1.0/len(agent.experiences)
+    cred_features = np.zeros((agent.num_actions, agent.iht_size))
+    for experience in agent.experiences:
+        exp_features= np.zeros((agent.num_actions, agent.iht_size))
+        exp_features[experience[0]][experience[1]]=1
+        exp_features*=weight_per_experience
+        cred_features = np.add(cred_features, exp_features)
+    error = r - agent.w * cred_features
+    agent.w += (.01*error*cred_features)
+
+@benchmark
+def bench_tamer(args):
+    from tamerAgent import TamerAgent
+    rng = np.random.default_rng(0)
+    print('feedback with n experiences in the window, per update:')
+    for window in (1, 30, 300):
+        dense, sparse = TamerAgent(), TamerAgent()
+        dense.window_size = sparse.window_size = float('inf')
+        states = np.column_stack((rng.uniform(-1.2, .5, window), rng.uniform(-.07, .07, window)))
+        for position, velocity in states:
+            experience = (int(rng.integers(3)), sparse.mctc.get_tiles(position, velocity), time.time())
+            dense.experiences.add(*experience)
+            sparse.experiences.add(*experience)
+        rewards = ['good', 'bad', 'reallygood']*10
+        start = time.perf_counter()
+        for reward in rewards:
+            dense_tamer_update(dense, {'good': 1, 'bad': -1, 'reallygood': 4}[reward])
+        denseTime = (time.perf_counter() - start)/len(rewards)
+        start = time.perf_counter()
+        for reward in rewards:
+            sparse.update_reward_function(reward)
+        sparseTime = (time.perf_counter() - start)/len(rewards)
+        assert np.array_equal(dense.w, sparse.w), 'sparse TAMER update differs from the dense one'
+        print(f'  n={window:<4} dense {denseTime*1e6:9.1f} us, sparse {sparseTime*1e6:8.1f} us, same weights')
+
+@benchmark
+def bench_window(args):
+    from experienceBuffer import ExperienceBuffer
+    # TAMER keeps every experience until feedback arrives, then drops the
+    # ones older than its 1 s window; about 30 steps a second
+    tiles = np.arange(8)
+    print('feedback after a gap, 1 s window:')
+    for gap in (10, 60, 600):
+        timestamps = (np.cumsum(np.random.default_rng(0).uniform(.5, 1.5, gap*30))/30).tolist()
+        now = timestamps[-1]
+        experiences = [(step % 3, tiles, timestamp) for step, timestamp in enumerate(timestamps)]
+        start = time.perf_counter()
+        while len(experiences) > 0:
+            if experiences[0][2] < now - 1:
+                experiences.pop(0)
+            else:
+                break
+        listTime = time.perf_counter() - start
+        buffer = ExperienceBuffer(1000)
+        for step, timestamp in enumerate(timestamps):
+            buffer.add(step % 3, tiles, timestamp)
+        start = time.perf_counter()
+        buffer.expire(now - 1)
+        bufferTime = time.perf_counter() - start
+        assert len(buffer) == len(experiences)
+        print(f'  {gap:>4} s: list held {len(timestamps)} experiences, trimmed in {listTime*1e3:.2f} ms; '
+              f'ExperienceBuffer held {min(len(timestamps), buffer.capacity)}, trimmed in {bufferTime*1e3:.3f} ms')
+
+def loop_argmax(q_values):
+    top = float("-inf")
+    ties = []
+    for i in range(len(q_values)):
+        if q_values[i] > top:
+            top = q_values[i]
+            ties = []
+        if q_values[i] == top:
+            ties.append(i)
+    return np.random.choice(ties)
+
+def loop_preferences(agent, tiles):
+    return [np.sum(agent.w[a][tiles]) for a in range(agent.num_actions)]
+
+def loop_gradient(agent, chosen_a, softmax_prob):
+    gradients = np.zeros(agent.w.shape[0])
+    for a in agent.actions:
+        gradients[a] = 1 - softmax_prob[a] if a == chosen_a else -softmax_prob[a]
+    return gradients
+
+def loop_trace(agent, trace, active_tiles, grad):
+    for a in agent.actions:
+        trace[a, active_tiles] = trace[a, active_tiles]*agent.trace_decay + grad[a]
+
+def time_per_call(func, *inputs, calls=2000):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func(*inputs)
+    return (time.perf_counter() - start)/calls
+
+@benchmark
+def bench_actions(args):
+    from tamerAgent import TamerAgent
+    from coachAgent import CoachAgent
+    rng = np.random.default_rng(0)
+    print('per call, loop over actions against vectorized:')
+    for numActions in (3, 18):
+        tamer, coach = TamerAgent(numActions), CoachAgent(numActions)
+        tamer.w = rng.normal(size=tamer.w.shape)
+        coach.w = rng.normal(size=coach.w.shape)
+        tiles = tamer.mctc.get_tiles(-.5, 0.01)
+        values = tamer.w[:, tiles].sum(axis=1)
+        assert np.allclose(loop_preferences(tamer, tiles), values)
+        assert tamer.argmax(values) == loop_argmax(values)
+        # every other action tied for the highest value
+        tied = values.copy()
+        tied[::2] = values.max() + 1
+        np.random.seed(0)
+        loopChoices = [loop_argmax(tied) for _ in range(100)]
+        np.random.seed(0)
+        assert loopChoices == [tamer.argmax(tied) for _ in range(100)], 'argmax breaks ties differently'
+        prob = coach.softmax(coach.calculate_action_preferences(tiles))
+        assert np.array_equal(loop_gradient(coach, 1, prob), coach.gradient_logsoftmax(1, prob))
+        grad = coach.gradient_logsoftmax(1, prob)
+        loopTrace = np.zeros(coach.w.shape)
+        for _ in range(3):
+            coach.update_trace(tiles, grad)
+            loop_trace(coach, loopTrace, tiles, grad)
+        assert np.array_equal(coach.trace.dense(), loopTrace), 'trace update differs from the loop'
+        rows = [('preferences', time_per_call(loop_preferences, coach, tiles),
+                 time_per_call(coach.calculate_action_preferences, tiles)),
+                ('argmax', time_per_call(loop_argmax, values), time_per_call(tamer.argmax, values)),
+                ('argmax, tie', time_per_call(loop_argmax, tied), time_per_call(tamer.argmax, tied)),
+                ('greedy action', time_per_call(lambda t: loop_argmax(loop_preferences(tamer, t)), tiles),
+                 time_per_call(tamer.select_greedy_action, tiles)),
+                ('gradient', time_per_call(loop_gradient, coach, 1, prob),
+                 time_per_call(coach.gradient_logsoftmax, 1, prob)),
+                ('trace', time_per_call(loop_trace, coach, loopTrace, tiles, grad),
+                 time_per_call(coach.update_trace, tiles, grad))]
+        print(f'  {numActions} actions:')
+        for name, loopTime, vectorTime in rows:
+            print(f'    {name:<14} loop {loopTime*1e6:7.1f} us, vectorized {vectorTime*1e6:6.1f} us')
+
+def dense_coach_update(agent, trace, r):
+    '''
+    The COACH update as it was written before the trace was made sparse,
+    crediting the newest experience.
+    '''
+    action, tiles, _ = agent.experiences[-1]
+    softmax_prob = agent.softmax(agent.calculate_action_preferences(tiles))
+    grad = agent.gradient_logsoftmax(action, softmax_prob)
+    trace[:, tiles] = trace[:, tiles]*agent.trace_decay + grad[:, None]
+    agent.w += agent.alpha*r*trace
+
+@benchmark
+def bench_coach(args):
+    from coachAgent import CoachAgent
+    from eligibilityTrace import EligibilityTrace
+    rng = np.random.default_rng(0)
+    rewards = {'good': 1, 'bad': -1, 'reallygood': 2, 'None': 0}
+    updates = max(args.steps//10, 100)
+    print(f'trace and weight update per step, dense against sparse, over {updates} updates:')
+    for share in (.1, .5):
+        dense, sparse = CoachAgent(), CoachAgent()
+        # credit the newest experience, so both agents see the same one
+        dense.feedback_delay = sparse.feedback_delay = 0
+        trace = np.zeros(dense.w.shape)
+        states = np.column_stack((rng.uniform(-1.2, .5, updates), rng.uniform(-.07, .07, updates)))
+        feedback = np.where(rng.random(updates) < share, rng.choice(['good', 'bad', 'reallygood'], updates), 'None')
+        steps = []
+        for (position, velocity), reward in zip(states, feedback.tolist()):
+            action = int(rng.integers(3))
+            tiles = sparse.mctc.get_tiles(position, velocity)
+            dense.experiences.add(action, tiles, time.time() - 1)
+            sparse.experiences.add(action, tiles, time.time() - 1)
+            grad = sparse.gradient_logsoftmax(action, sparse.softmax(sparse.calculate_action_preferences(tiles)))
+            steps.append((tiles, grad, sparse.alpha*rewards[reward]))
+            dense_coach_update(dense, trace, rewards[reward])
+            sparse.update_policy(reward)
+        assert np.array_equal(dense.w, sparse.w), 'sparse COACH update differs from the dense one'
+        assert np.array_equal(trace, sparse.trace.dense())
+        # the same trace and weight updates again, timed on their own
+        w, trace = np.ones(dense.w.shape), np.zeros(dense.w.shape)
+        start = time.perf_counter()
+        for tiles, grad, step in steps:
+            trace[:, tiles] = trace[:, tiles]*dense.trace_decay + grad[:, None]
+            w += step*trace
+        denseTime = (time.perf_counter() - start)/updates
+        w, eligibility = np.ones(dense.w.shape), EligibilityTrace(w.shape, sparse.trace_decay)
+        start = time.perf_counter()
+        for tiles, grad, step in steps:
+            eligibility.update(tiles, grad)
+            if step != 0:
+                eligibility.apply(w, step)
+        sparseTime = (time.perf_counter() - start)/updates
+        print(f'  {share:.0%} feedback: dense {denseTime*1e6:6.1f} us, sparse {sparseTime*1e6:6.1f} us, '
+              f'{len(sparse.trace)} active tiles, same weights')
+
+def main():
+    parser = argparse.ArgumentParser(description='Backend benchmarks')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f'one of {", ".join(BENCHMARKS)}, all by default')
+    parser.add_argument('--game', default='MountainCar-v0', help='gym environment for startup')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--demos', type=int, default=5000, help='demos for the demos benchmark')
+    parser.add_argument('--states', type=int, default=10000, help='states for the tiles benchmark')
+    parser.add_argument('--steps', type=int, default=100000, help='steps for the transitions and archive benchmarks')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmark: {", ".join(sorted(unknown))}')
+    for name in args.benchmarks or list(BENCHMARKS):
+        print(f'== {name}')
+        BENCHMARKS[name](args)
+
+if __name__ == '__main__':
+    main()
@@ -8,123 +8,9 @@ import gym
 import time
 import numpy as np
 import itertools
-
-
-#This is the code for tile coding features
-basehash = hash
-
-class IHT:
-    "Structure to handle collisions"
-    def __init__(self, sizeval):
-        self.size = sizeval                        
-        self.overfullCount = 0
-        self.dictionary = {}
-
-    def __str__(self):
-        "Prepares a string for printing whenever this object is printed"
-        return "Collision table:" + " size:" + str(self.size) + " overfullCount:" + str(self.overfullCount) + " dictionary:" + str(len(self.dictionary)) + " items"
-
-    def count (self):
-        return len(self.dictionary)
-    
-    def fullp (self):
-        return len(self.dictionary) >= self.size
-    
-    def getindex (self, obj, readonly=False):
-        d = self.dictionary
-        if obj in d: return d[obj]
-        elif readonly: return None
-        size = self.size
-        count = self.count()
-        if count >= size:
-            if self.overfullCount==0: print('IHT full, starting to allow collisions')
-            self.overfullCount += 1
-            return basehash(obj) % self.size
-        else:
-            d[obj] = count
-            return count
-
-def hashcoords(coordinates, m, readonly=False):
-    if type(m)==IHT: return m.getindex(tuple(coordinates), readonly)
-    if type(m)==int: return basehash(tuple(coordinates)) % m
-    if m==None: return coordinates
-
-from math import floor, log
-from itertools import zip_longest
-
-def tiles (ihtORsize, numtilings, floats, ints=[], readonly=False):
-    """returns num-tilings tile indices corresponding to the floats and ints"""
-    qfloats = [floor(f*numtilings) for f in floats]
-    Tiles = []
-    for tiling in range(numtilings):
-        tilingX2 = tiling*2
-        coords = [tiling]
-        b = tiling
-        for q in qfloats:
-            coords.append( (q + b) // numtilings )
-            b += tilingX2
-        coords.extend(ints)
-        Tiles.append(hashcoords(coords, ihtORsize, readonly))
-    return Tiles
-
-def tileswrap (ihtORsize, numtilings, floats, wrapwidths, ints=[], readonly=False):
-    """returns num-tilings tile indices corresponding to the floats and ints, wrapping some floats"""
-    qfloats = [floor(f*numtilings) for f in floats]
-    Tiles = []
-    for tiling in range(numtilings):
-        tilingX2 = tiling*2
-        coords = [tiling]
-        b = tiling
-        for q, width in zip_longest(qfloats, wrapwidths):
-            c = (q + b%numtilings) // numtilings
-            coords.append(c%width if width else c)
-            b += tilingX2
-        coords.extend(ints)
-        Tiles.append(hashcoords(coords, ihtORsize, readonly))
-    return Tiles
-
-
-class MountainCarTileCoder:
-    def __init__(self, iht_size=4096, num_tilings=8, num_tiles=8):
-        """
-            Initializes the MountainCar Tile Coder
-            
-            iht_size -- int, the size of the index hash table, typically a power of 2
-            num_tilings -- int, the number of tilings
-            num_tiles -- int, the number of tiles. Here both the width and height of the
-            tile coder are the same
-            """
-        self.iht = IHT(iht_size)
-        self.num_tilings = num_tilings
-        self.num_tiles = num_tiles
-            
-    def get_tiles(self, position, velocity):
-        """
-            Takes in a position and velocity from the mountaincar environment
-            and returns a numpy array of active tiles.
-            
-            returns:
-            tiles - np.array, active tiles
-            """
-        # Use the ranges above and self.num_tiles to scale position and velocity to the range [0, 1]
-        # then multiply that range with self.num_tiles so it scales from [0, num_tiles]
-        minP=-1.2
-        maxP=.5
-        minV=-.07
-        maxV=.07
-        scaleP= maxP- minP
-        scaleV= maxV-minV
-        
-        position_scaled = ((position-minP)/(scaleP))*self.num_tiles
-        
-        velocity_scaled = ((velocity-minV)/(scaleV))*self.num_tiles
-        
-        
-        # get the tiles using tc.tiles, with self.iht, self.num_tilings and [scaled position, scaled velocity]
-        # nothing to implment here
-        mytiles = tiles(self.iht, self.num_tilings, [position_scaled, velocity_scaled])
-        
-        return np.array(mytiles)
+from tileCoding import MountainCarTileCoder
+from experienceBuffer import ExperienceBuffer
+from eligibilityTrace import EligibilityTrace
 
 
 #this is the coach agent class
@@ -134,7 +20,7 @@ class CoachAgent:
         Initialization of Tamer Agent. All values are set to None so they can
         be initialized in the agent_init method.
         """
-    def __init__(self):
+    def __init__(self, num_actions=3):
         self.last_action = None
         self.previous_tiles = None
         self.first_state= None
@@ -147,14 +33,15 @@ class CoachAgent:
         self.epsilon = 0.1
         self.gamma = 0 # this is discount
         self.trace_decay = 0.9 # trace decay parameter (lambda in COACH paper)
+        self.decay_all_traces = False # decay the whole trace every update, not only the active tiles
         self.x = 0.3 # was 0.12, 0.2
         self.alpha =self.x/self.num_tilings  #this is step size
         self.initial_weights =  0.0
-        self.num_actions = 3
+        self.num_actions = num_actions
         self.actions = list(range(self.num_actions))
         self.time_step=0
-        self.experiences= list()
         self.max_n_experiences=1000
+        self.experiences= ExperienceBuffer(self.max_n_experiences)
         self.window_size = 2
         self.feedback_delay = 0.6
         self.timestamp = time.time()
@@ -165,33 +52,35 @@ class CoachAgent:
         self.w = np.ones((self.num_actions, self.iht_size))
         
         
-        # intialize trace to be same size as w
-        self.trace = np.zeros(self.w.shape)
+        # intialize trace to be same size as w; it only keeps track of the
+        # tiles it is nonzero on
+        self.trace = EligibilityTrace(self.w.shape, self.trace_decay, decayAll=self.decay_all_traces)
         
-        self.softmax_prob = [0,0,0]
+        self.softmax_prob = np.zeros(self.num_actions)
         
         # We initialize self.mctc to the mountaincar verions of the
-        # tile coder that we created
+        # tile coder that we created. Its position/velocity grid is bounded, so
+        # tiles are indexed directly, without a hash table or collisions
         
         self.mctc = MountainCarTileCoder(iht_size=self.iht_size,
                                          num_tilings=self.num_tilings,
-                                         num_tiles=self.num_tiles)
+                                         num_tiles=self.num_tiles,
+                                         direct=True)
     
 
     def calculate_action_preferences(self, tiles):
-        preferences = []    
-        for a in range(self.num_actions):
-            preferences.append(np.sum(self.w[a][tiles]))
+        # the preference of each action is the sum of its weights for the active tiles
+        return self.w[:, tiles].sum(axis=1)
 
-        return preferences
+    def softmax(self, preferences):
+        c = np.max(preferences)
+        numerator = np.exp(preferences - c)
+        denominator = np.sum(numerator)
+        return numerator/denominator
 
     def gradient_logsoftmax(self, chosen_a, softmax_prob):   
-        gradients = np.zeros(self.w.shape[0])
-        for a in self.actions:
-            if a == chosen_a:
-                gradients[a] = (1 - softmax_prob[a])
-            else:
-                gradients[a] = -softmax_prob[a]
+        gradients = np.negative(softmax_prob)
+        gradients[chosen_a] += 1
         
         return gradients
 
@@ -203,10 +92,7 @@ class CoachAgent:
         active_tiles=self.mctc.get_tiles(position, velocity)
         
         preferences = self.calculate_action_preferences(active_tiles)
-        c = np.max(preferences)
-        numerator = np.exp(preferences - c)
-        denominator = np.sum(numerator)
-        softmax_prob = np.array(numerator/denominator)
+        softmax_prob = self.softmax(preferences)
         chosen_action = np.random.choice(self.actions, p=softmax_prob)
         
         self.current_action = chosen_action
@@ -232,12 +118,11 @@ class CoachAgent:
         self.current_action = np.random.choice(self.actions)
         self.current_tiles= np.copy(active_tiles)
         
-        self.experiences.append((self.current_action, self.current_tiles, time.time()))
+        self.experiences.add(self.current_action, self.current_tiles, time.time())
         return self.current_action
 
     def update_trace(self, active_tiles, grad):
-        for a in self.actions:
-            self.trace[a,active_tiles] = self.trace[a,active_tiles]*self.trace_decay + grad[a] 
+        self.trace.update(active_tiles, grad)
         
 
     
@@ -256,38 +141,27 @@ class CoachAgent:
         # First get state-action pair to be assigned credit
         current_time = time.time()
         
-        i = 0                           # index for experience
-        dt = self.feedback_delay + 1      # arbitrary value > self.feedback_delay
-        
-        if len(self.experiences) > 0:
-
-            while dt > self.feedback_delay:
-                expr = self.experiences[i] 
-                dt = current_time - expr[2]  # index 2 of experience holds the timestamp
-                i += 1    
-                if i > len(self.experiences)-1:
-                    break
-            i -= 1 # decrement i so that it corresponds to expr
-        else:
+        if len(self.experiences) == 0:
             return  # the experience buffer is empty; no update is possible
+
+        # the first experience at most feedback_delay old, or the newest one
+        # if they are all older
+        i = min(self.experiences.find(current_time - self.feedback_delay), len(self.experiences) - 1)
         
-        # now expr holds the right state-action pair for the update
+        self.experiences.discard(i)   # remove old experiences from buffer
+        expr = self.experiences[0]
         
-        self.experiences = self.experiences[i:]   # remove old experiences from buffer
+        # now expr holds the right state-action pair for the update
         
         preferences = self.calculate_action_preferences(expr[1])
-        
-        
-        c = np.max(preferences)
-        numerator = np.exp(preferences - c)
-        denominator = np.sum(numerator)
-        softmax_prob = numerator/denominator
+        softmax_prob = self.softmax(preferences)
         
         grad = self.gradient_logsoftmax(expr[0], softmax_prob)
         self.update_trace(expr[1],grad) 
         
-        # update w
-        self.w += self.alpha*r*self.trace
+        # update w, on the tiles the trace is nonzero on; no feedback leaves it as it is
+        if r != 0:
+            self.trace.apply(self.w, self.alpha*r)
 
 
    
@@ -311,13 +185,15 @@ class Agent():
     Use this class as a convenient place to store agent state.
     '''
 
-    def start(self, game:str):
+    def start(self, game:str, pool=None):
         '''
-        Starts an OpenAI gym environment.
+        Starts an OpenAI gym environment, taken from the trial's EnvPool when
+        one is given.
         Caller:
             - Trial.start()
         Inputs:
             -   game (Type: str corresponding to allowable gym environments)
+            -   pool (Type: EnvPool of pre-created environments, optional)
         Returs:
             - env (Type: OpenAI gym Environment as returned by gym.make())
             Mandatory
@@ -325,8 +201,10 @@ class Agent():
         self.coach = true
         if self.coach:
             np.random.seed(0)
-            self.coachAgent = CoachAgent()
-        self.env = gym.make(game)
+        self.pool = pool if pool is not None and pool.game == game else None
+        self.env = self.pool.acquire() if self.pool is not None else gym.make(game)
+        if self.coach:
+            self.coachAgent = CoachAgent(num_actions=self.env.action_space.n)
         return
 
     def step(self, action, reward):
@@ -365,7 +243,7 @@ class Agent():
 
         if self.coach:
             self.coachAgent.action_selection(observation)
-            self.coachAgent.experiences.append((self.coachAgent.current_action, self.coachAgent.current_tiles, time.time()))
+            self.coachAgent.experiences.add(self.coachAgent.current_action, self.coachAgent.current_tiles, time.time())
         return envState
 
     def render(self):
@@ -399,7 +277,8 @@ class Agent():
 
     def close(self):
         '''
-        Closes the environment at the end of the trial.
+        Closes the environment at the end of the trial, or gives it back to
+        the pool it came from.
         Caller:
             - Trial.close()
         Inputs:
@@ -407,5 +286,8 @@ class Agent():
         Returns:
             No Return
         '''
-        self.env.close()
+        if self.pool is not None:
+            self.pool.release(self.env)
+        else:
+            self.env.close()
 
@@ -0,0 +1,141 @@
+'''
+Compact, memory-mapped storage for demonstration action sequences.
+Demos are mostly long runs of the same action, so each one is stored
+run-length encoded: the run values (uint8) and run lengths (uint32) of all
+demos are concatenated into two .npy files and an index maps each demo id
+to its runs. The files are memory-mapped, so only the pages of the demos
+that are actually played are read, and forked worker processes share them.
+'''
+import json
+import os
+import numpy as np
+
+INDEX_COLUMNS = ('demoId', 'offset', 'runs', 'steps')
+
+def run_length_encode(actions):
+    '''
+    Inputs:
+        - actions (Type: sequence of ints in 0..255)
+    Returns:
+        - values (Type: uint8 npArray of the action of each run)
+        - lengths (Type: uint32 npArray of the length of each run)
+    '''
+    actions = np.asarray(actions)
+    if actions.size and (actions.min() < 0 or actions.max() > 255):
+        raise ValueError('Demo actions must fit in a uint8')
+    actions = actions.astype(np.uint8)
+    if actions.size == 0:
+        return actions, np.zeros(0, dtype=np.uint32)
+    starts = np.concatenate(([0], np.flatnonzero(actions[1:] != actions[:-1]) + 1))
+    lengths = np.diff(np.append(starts, actions.size)).astype(np.uint32)
+    return actions[starts], lengths
+
+def save_array(path, array):
+    '''
+    Writes path atomically, so a process that has the old file mapped, or
+    opens it during a rebuild, never sees a partial file.
+    '''
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as outfile:
+        np.save(outfile, array)
+    os.replace(tmp, path)
+
+class DemoStore():
+    '''
+    Read-only mapping of demo id to its actions (uint8 npArray), decoded on
+    each access. Files are opened on first use.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.values = None
+        self.lengths = None
+        self.ids = None
+
+    @staticmethod
+    def build(path, demos):
+        '''
+        Writes a store for demos (dict of demo id to list of actions) to the
+        directory path.
+        '''
+        os.makedirs(path, exist_ok=True)
+        ids = sorted(demos)
+        index = np.zeros((len(ids), len(INDEX_COLUMNS)), dtype=np.int64)
+        values, lengths = [], []
+        offset = 0
+        for row, demoId in enumerate(ids):
+            runValues, runLengths = run_length_encode(demos[demoId])
+            index[row] = (demoId, offset, len(runValues), runLengths.sum())
+            values.append(runValues)
+            lengths.append(runLengths)
+            offset += len(runValues)
+        save_array(os.path.join(path, 'values.npy'),
+                   np.concatenate(values) if values else np.zeros(0, dtype=np.uint8))
+        save_array(os.path.join(path, 'lengths.npy'),
+                   np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.uint32))
+        # written last, a store is complete once its index exists
+        save_array(os.path.join(path, 'index.npy'), index)
+
+    @classmethod
+    def from_json(cls, jsonFile, path):
+        '''
+        Opens the store in path, building it first from jsonFile (demo id to
+        list of actions) if it does not exist or is older than jsonFile.
+        '''
+        indexFile = os.path.join(path, 'index.npy')
+        if not os.path.exists(indexFile) or os.path.getmtime(indexFile) < os.path.getmtime(jsonFile):
+            with open(jsonFile) as infile:
+                demos = {int(demoId): actions for demoId, actions in json.load(infile).items()}
+            cls.build(path, demos)
+        return cls(path)
+
+    def open(self):
+        if self.index is None:
+            self.values = np.load(os.path.join(self.path, 'values.npy'), mmap_mode='r')
+            self.lengths = np.load(os.path.join(self.path, 'lengths.npy'), mmap_mode='r')
+            # the index is small and searched on every access, so it is read in full
+            self.index = np.load(os.path.join(self.path, 'index.npy'))
+            self.ids = self.index[:, 0]
+
+    def find(self, demoId):
+        self.open()
+        row = self.ids.searchsorted(demoId)
+        if row == len(self.ids) or self.ids[row] != demoId:
+            raise KeyError(demoId)
+        return self.index[row].tolist()
+
+    def __getitem__(self, demoId):
+        _, offset, runs, _ = self.find(demoId)
+        return np.repeat(self.values[offset:offset + runs], self.lengths[offset:offset + runs])
+
+    def get(self, demoId, default=None):
+        try:
+            return self[demoId]
+        except KeyError:
+            return default
+
+    def steps(self, demoId):
+        return self.find(demoId)[3]
+
+    def __contains__(self, demoId):
+        try:
+            self.find(demoId)
+            return True
+        except KeyError:
+            return False
+
+    def keys(self):
+        self.open()
+        return self.ids.tolist()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        self.open()
+        return len(self.index)
+
+    def nbytes(self):
+        self.open()
+        return self.values.nbytes + self.lengths.nbytes + self.index.nbytes
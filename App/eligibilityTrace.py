@@ -0,0 +1,107 @@
+'''
+Sparse eligibility trace of the COACH agent, over (action, tile) weights.
+COACH updates the trace of all actions for the active tiles of an experience,
+so the trace is nonzero only on the tiles (columns) of the experiences it has
+seen. Only those columns, and the range they span, are kept track of, and
+adding the trace to the weights touches only that range, or the columns
+themselves when they are scattered over a much wider range, instead of
+every action and tile.
+By default, like COACH always did, the trace decays only on the tiles it is
+updated on. With decayAll the whole trace decays every update; the decay is
+then applied lazily through a global scale factor, and columns that decayed
+below tolerance are dropped when the values are rescaled.
+'''
+import numpy as np
+
+class EligibilityTrace():
+    '''
+    The trace is values*scale; values has the shape of the weights and is
+    only nonzero on the columns in self.active.
+    '''
+
+    def __init__(self, shape, decay, decayAll=False, tolerance=1e-12):
+        self.values = np.zeros(shape)
+        self.decay = decay
+        self.decayAll = decayAll
+        self.tolerance = tolerance
+        self.scale = 1.0
+        self.active = set()
+        self.activeColumns = None # sorted array of self.active, rebuilt when it changes
+        self.start = 0 # the active columns are in [start, end)
+        self.end = 0
+
+    def update(self, tiles, grad):
+        '''
+        Decays the trace and adds grad[a] to the trace of each action a on tiles.
+        Inputs:
+            - tiles (Type: int npArray of active tiles)
+            - grad (Type: float npArray with one value per action)
+        '''
+        columns = tiles.tolist()
+        count = len(self.active)
+        self.active.update(columns)
+        if len(self.active) != count:
+            self.activeColumns = None
+            if count == 0:
+                self.start, self.end = min(columns), max(columns) + 1
+            else:
+                self.start, self.end = min(self.start, *columns), max(self.end, max(columns) + 1)
+        if self.decayAll:
+            self.scale *= self.decay
+            self.values[:, tiles] += grad[:, None]/self.scale
+            if self.scale < 1e-100:
+                self.rescale()
+        else:
+            self.values[:, tiles] = self.values[:, tiles]*self.decay + grad[:, None]
+
+    def rescale(self):
+        '''
+        Folds the scale into the values and drops the columns that decayed
+        below tolerance.
+        '''
+        columns = self.columns()
+        values = self.values[:, columns]*self.scale
+        negligible = np.all(np.abs(values) < self.tolerance, axis=0)
+        values[:, negligible] = 0
+        self.values[:, columns] = values
+        self.scale = 1.0
+        if negligible.any():
+            self.active.difference_update(columns[negligible].tolist())
+            self.activeColumns = None
+            columns = self.columns()
+            self.start, self.end = (int(columns[0]), int(columns[-1]) + 1) if len(columns) else (0, 0)
+
+    def columns(self):
+        if self.activeColumns is None:
+            self.activeColumns = np.array(sorted(self.active), dtype=np.int64)
+        return self.activeColumns
+
+    def apply(self, w, step):
+        '''
+        w += step*trace, on the active columns only.
+        '''
+        if self.scale != 1.0:
+            step = step*self.scale
+        if self.end - self.start <= 4*len(self.active):
+            # a slice is much cheaper than indexing, the zeros in it do not change w
+            w[:, self.start:self.end] += step*self.values[:, self.start:self.end]
+        else:
+            columns = self.columns()
+            w[:, columns] += step*self.values[:, columns]
+
+    def dense(self):
+        '''
+        Returns:
+            - trace (Type: float npArray of the weights' shape)
+        '''
+        return self.values*self.scale
+
+    def clear(self):
+        self.values[:, self.start:self.end] = 0
+        self.scale = 1.0
+        self.active.clear()
+        self.activeColumns = None
+        self.start = self.end = 0
+
+    def __len__(self):
+        return len(self.active)
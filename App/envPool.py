@@ -0,0 +1,101 @@
+'''
+Pool of pre-created gym environments for one game.
+gym.make() and, for Box2D/pyglet games, the first render can take seconds.
+The pool creates envPoolSize environments when the process starts, hands
+them to Agents as sessions start and takes them back when the Agent is
+closed, so a participant does not wait for environment construction.
+'''
+from collections import deque
+import gym
+from hippoLogging import get_logger
+
+log = get_logger('envPool')
+
+def close_env(env):
+    try:
+        env.close()
+    except Exception:
+        log.exception('Failed to close environment')
+
+class EnvPool():
+    '''
+    Idle environments are kept in a queue. An environment is checked with a
+    reset and a throwaway render when it is created and when it is given
+    back; one that fails is closed instead of being handed out again. When
+    the pool is empty acquire() falls back to gym.make().
+    '''
+
+    def __init__(self, game, size=2):
+        self.game = game
+        self.size = size
+        self.idle = deque()
+        self.metrics = {'created': 0, 'hits': 0, 'misses': 0, 'recycled': 0, 'discarded': 0}
+
+    def warm(self):
+        '''
+        Creates environments until size are idle.
+        '''
+        while len(self.idle) < self.size:
+            env = self.create()
+            if not self.check(env):
+                break
+            self.idle.append(env)
+        log.info('Warmed %s %s environments', len(self.idle), self.game)
+
+    def create(self):
+        self.metrics['created'] += 1
+        return gym.make(self.game)
+
+    def check(self, env):
+        '''
+        Returns:
+            - healthy (Type: bool, False if reset or render raised, in which
+              case env has been closed)
+        '''
+        try:
+            env.reset()
+            env.render('rgb_array')
+            return True
+        except Exception:
+            log.exception('%s environment failed its health check, discarding it', self.game)
+            self.discard(env)
+            return False
+
+    def discard(self, env):
+        self.metrics['discarded'] += 1
+        close_env(env)
+
+    def acquire(self):
+        '''
+        Caller:
+            - Agent.start()
+        Returns:
+            - env (Type: OpenAI gym Environment)
+        '''
+        if self.idle:
+            self.metrics['hits'] += 1
+            return self.idle.popleft()
+        self.metrics['misses'] += 1
+        return self.create()
+
+    def release(self, env):
+        '''
+        Takes an environment back from a closed Agent, keeping it if there is
+        room and it still resets and renders.
+        Caller:
+            - Agent.close()
+        '''
+        if env is None or any(env is idle for idle in self.idle):
+            return
+        if len(self.idle) >= self.size:
+            self.discard(env)
+        elif self.check(env):
+            self.metrics['recycled'] += 1
+            self.idle.append(env)
+
+    def close(self):
+        while self.idle:
+            close_env(self.idle.popleft())
+
+    def stats(self):
+        return dict(self.metrics, idle=len(self.idle))
@@ -0,0 +1,116 @@
+'''
+Archive format for the transitions an Agent recorded in its TransitionBuffer.
+An archive is either
+    - a directory with one .npy file per column and a metadata.json, which
+      load_archive() memory-maps, so offline analysis only reads the pages
+      it touches, or
+    - a single compressed .npz file (any path ending in .npz), smaller to
+      upload but read into memory when loaded.
+The columns are the ones from TransitionBuffer.columns(): observations are
+stored once per episode and next_obs is derived when reading.
+'''
+import csv
+import json
+import os
+import time
+import numpy as np
+from demoStore import save_array
+from transitionBuffer import TransitionBuffer
+
+ARCHIVE_VERSION = 1
+ARCHIVE_COLUMNS = ('obs', 'action', 'reward', 'dones', 'episodeStarts')
+
+def save_archive(path, buffer, metadata=None):
+    '''
+    Inputs:
+        - path (Type: str directory, or file name ending in .npz to compress)
+        - buffer (Type: TransitionBuffer)
+        - metadata (Type: dict, JSON serializable, e.g. trialId and game)
+    Returns:
+        - metadata (Type: dict as stored, with the archive's own fields added)
+    '''
+    columns = buffer.columns()
+    metadata = dict(metadata or {}, version=ARCHIVE_VERSION, created=time.time(),
+                    steps=len(buffer), episodes=buffer.episodes(),
+                    obsShape=list(columns['obs'].shape[1:]))
+    if path.endswith('.npz'):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as outfile:
+            np.savez_compressed(outfile, metadata=np.array(json.dumps(metadata)), **columns)
+        os.replace(tmp, path)
+        return metadata
+    os.makedirs(path, exist_ok=True)
+    for name in ARCHIVE_COLUMNS:
+        save_array(os.path.join(path, name + '.npy'), columns[name])
+    # written last, an archive is complete once its metadata exists
+    tmp = os.path.join(path, f'metadata.json.{os.getpid()}.tmp')
+    with open(tmp, 'w') as outfile:
+        json.dump(metadata, outfile)
+    os.replace(tmp, os.path.join(path, 'metadata.json'))
+    return metadata
+
+def load_archive(path, mmap=True):
+    '''
+    Returns:
+        - buffer (Type: TransitionBuffer over the archived columns, memory-mapped
+          read-only for a directory archive unless mmap is False)
+        - metadata (Type: dict)
+    '''
+    if path.endswith('.npz'):
+        with np.load(path) as archive:
+            columns = {name: archive[name] for name in ARCHIVE_COLUMNS}
+            metadata = json.loads(str(archive['metadata']))
+    else:
+        with open(os.path.join(path, 'metadata.json')) as infile:
+            metadata = json.load(infile)
+        columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+                   for name in ARCHIVE_COLUMNS}
+    if metadata.get('version') != ARCHIVE_VERSION:
+        raise ValueError(f'{path} is an episode archive of unsupported version {metadata.get("version")}')
+    return TransitionBuffer.from_columns(columns), metadata
+
+def export_csv(fileName, buffer):
+    '''
+    Writes one row per step: episode, step, obs_0.., action, reward, done,
+    next_obs_0.. (observations are flattened).
+    '''
+    with open(fileName, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        header = None
+        for idx in range(buffer.episodes()):
+            episode = buffer.episode(idx)
+            obs = np.asarray(episode['obs']).reshape(len(episode['obs']), -1)
+            nextObs = np.asarray(episode['next_obs']).reshape(len(episode['next_obs']), -1)
+            if header is None:
+                width = obs.shape[1]
+                header = (['episode', 'step'] + [f'obs_{i}' for i in range(width)]
+                          + ['action', 'reward', 'done'] + [f'next_obs_{i}' for i in range(width)])
+                writer.writerow(header)
+            # astype(str) prints the shortest repr of the float32 values
+            columns = zip(obs.astype(str).tolist(), episode['action'].tolist(),
+                          episode['reward'].astype(str).tolist(), episode['dones'].tolist(),
+                          nextObs.astype(str).tolist())
+            for step, (o, action, reward, done, n) in enumerate(columns):
+                writer.writerow([idx, step] + o + [action, reward, int(done)] + n)
+
+def write_csv(fileName, data):
+    '''
+    Writes data as CSV. data can be a TransitionBuffer (see export_csv), a
+    list of dicts (one row each), a dict of equally long lists (one column
+    each) or a dict of values (a single row).
+    '''
+    if isinstance(data, TransitionBuffer):
+        export_csv(fileName, data)
+        return
+    if isinstance(data, dict):
+        if data and all(isinstance(value, (list, tuple, np.ndarray)) for value in data.values()):
+            rows = [dict(zip(data, values)) for values in zip(*data.values())]
+        else:
+            rows = [data]
+    else:
+        rows = list(data)
+    fields = list(dict.fromkeys(key for row in rows for key in row))
+    with open(fileName, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
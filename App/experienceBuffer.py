@@ -0,0 +1,113 @@
+'''
+Fixed-capacity ring buffer of the (action, tiles, timestamp) experiences the
+TAMER and COACH agents assign human feedback to.
+Experiences are added in time order into preallocated NumPy arrays. Once
+the buffer holds capacity experiences the oldest one is overwritten, and
+dropping old experiences only moves the start of the ring, so both are O(1).
+Timestamps are sorted, so the experiences of a time window are found by
+binary search.
+'''
+import numpy as np
+
+class ExperienceBuffer():
+    '''
+    Indexing is from the oldest experience: buffer[0] is the oldest and
+    buffer[-1] the newest, as an (action, tiles, timestamp) tuple where tiles
+    is a view into the buffer.
+    '''
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.tiles = None # allocated on the first add, when the number of tiles is known
+        self.start = 0 # position of the oldest experience
+        self.count = 0
+
+    def add(self, action, tiles, timestamp):
+        if self.tiles is None:
+            self.tiles = np.zeros((self.capacity, len(tiles)), dtype=np.int64)
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+        position = (self.start + self.count) % self.capacity
+        self.actions[position] = action
+        self.tiles[position] = tiles
+        self.timestamps[position] = timestamp
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def position(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        return (self.start + idx) % self.capacity
+
+    def __getitem__(self, idx):
+        position = self.position(idx)
+        return (int(self.actions[position]), self.tiles[position], float(self.timestamps[position]))
+
+    def __iter__(self):
+        return (self[idx] for idx in range(self.count))
+
+    def segments(self):
+        '''
+        Returns:
+            - segments (Type: list of (start, end) positions covering the
+              experiences from oldest to newest, one or two of them)
+        '''
+        end = self.start + self.count
+        if end <= self.capacity:
+            return [(self.start, end)]
+        return [(self.start, self.capacity), (0, end - self.capacity)]
+
+    def find(self, since):
+        '''
+        Returns:
+            - idx (Type: int index of the first experience with a timestamp
+              >= since, len(self) if there is none)
+        '''
+        idx = 0
+        for start, end in self.segments():
+            found = int(np.searchsorted(self.timestamps[start:end], since))
+            if found < end - start:
+                return idx + found
+            idx += end - start
+        return idx
+
+    def discard(self, n):
+        '''
+        Drops the n oldest experiences.
+        '''
+        n = min(n, self.count)
+        self.start = (self.start + n) % self.capacity
+        self.count -= n
+
+    def expire(self, before):
+        '''
+        Drops the experiences with a timestamp older than before.
+        '''
+        self.discard(self.find(before))
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+    def ordered(self, column):
+        positions = (self.start + np.arange(self.count)) % self.capacity
+        return column[positions]
+
+    def window_actions(self):
+        return self.ordered(self.actions)
+
+    def window_tiles(self):
+        '''
+        Returns:
+            - tiles (Type: int64 npArray of shape (len(self), tiles per experience))
+        '''
+        if self.tiles is None:
+            return np.zeros((0, 0), dtype=np.int64)
+        return self.ordered(self.tiles)
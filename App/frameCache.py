@@ -0,0 +1,252 @@
+'''
+Cache of encoded frames for demo playback in the 'pref' modality.
+Every participant watches the same demos from the same seed, so the frames
+of a demo only need to be simulated, rendered and encoded once. The first
+playback records the encoded frames, later playbacks stream them from
+memory (or from a memory-mapped file) without touching the environment.
+Entries are keyed by game, seed, demo and encoder settings and evicted
+least recently used first once frameCacheMB is exceeded.
+'''
+import hashlib
+import json
+import mmap
+import os
+import struct
+from collections import OrderedDict, deque
+import numpy as np
+from frameEncoder import DeltaEncoder
+from hippoLogging import get_logger
+
+log = get_logger('frameCache')
+
+FILE_MAGIC = b'HGFC'
+FILE_HEADER = struct.Struct('!4sI') # magic, length of the JSON table that follows
+
+def cache_key(game, seed, demoId, actions, encoder):
+    '''
+    Returns:
+        - key (Type: tuple of everything the cached frames depend on)
+    '''
+    digest = hashlib.sha1(np.asarray(actions, dtype=np.uint8).tobytes()).hexdigest()[:16]
+    return (game, seed, demoId, digest) + encoder.settings()
+
+class CachedDemo():
+    '''
+    The frames of one demo. Every frame has its full encoding and, when
+    delta frames are enabled, the patches that turn the previous frame into
+    it (None when a keyframe is needed anyway).
+    '''
+
+    def __init__(self, frames, patches):
+        self.frames = frames
+        self.patchLists = patches
+        self.nbytes = (sum(len(frame) for frame in frames)
+                       + sum(len(patch) for patchList in patches if patchList
+                             for x, y, patch in patchList))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def frame(self, idx):
+        return self.frames[idx]
+
+    def patches(self, idx):
+        return self.patchLists[idx]
+
+    def close(self):
+        pass
+
+class MappedDemo():
+    '''
+    A CachedDemo read from a cache file. The file is memory-mapped, and a
+    frame is only read when it is streamed.
+    '''
+
+    def __init__(self, fileName):
+        with open(fileName, 'rb') as infile:
+            self.buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, tableLength = FILE_HEADER.unpack_from(self.buffer)
+        if magic != FILE_MAGIC:
+            self.buffer.close()
+            raise ValueError(f'{fileName} is not a frame cache file')
+        start = FILE_HEADER.size
+        table = json.loads(self.buffer[start:start + tableLength])
+        self.dataStart = start + tableLength
+        self.frameTable = table['frames']
+        self.patchTable = table['patches']
+        self.nbytes = len(self.buffer)
+
+    @staticmethod
+    def save(fileName, demo):
+        '''
+        Writes demo (a CachedDemo) to fileName, atomically.
+        '''
+        frames, patches, offset = [], [], 0
+        for idx in range(len(demo)):
+            frames.append([offset, len(demo.frame(idx))])
+            offset += len(demo.frame(idx))
+        for idx in range(len(demo)):
+            patchList = demo.patches(idx)
+            if patchList is None:
+                patches.append(None)
+                continue
+            patches.append([])
+            for x, y, patch in patchList:
+                patches[-1].append([x, y, offset, len(patch)])
+                offset += len(patch)
+        table = json.dumps({'frames': frames, 'patches': patches}, separators=(',', ':')).encode('utf-8')
+        tmp = f'{fileName}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as outfile:
+            outfile.write(FILE_HEADER.pack(FILE_MAGIC, len(table)))
+            outfile.write(table)
+            for idx in range(len(demo)):
+                outfile.write(demo.frame(idx))
+            for idx in range(len(demo)):
+                for x, y, patch in demo.patches(idx) or ():
+                    outfile.write(patch)
+        os.replace(tmp, fileName)
+
+    def __len__(self):
+        return len(self.frameTable)
+
+    def read(self, offset, length):
+        start = self.dataStart + offset
+        return self.buffer[start:start + length]
+
+    def frame(self, idx):
+        return self.read(*self.frameTable[idx])
+
+    def patches(self, idx):
+        patchList = self.patchTable[idx]
+        if patchList is None:
+            return None
+        return [(x, y, self.read(offset, length)) for x, y, offset, length in patchList]
+
+    def close(self):
+        self.buffer.close()
+
+class FrameCache():
+    '''
+    LRU cache of CachedDemos under a budget of budgetMB. With a path, demos
+    are also written there and memory-mapped from the file, so they survive
+    eviction and restarts and can be built offline.
+    '''
+
+    def __init__(self, budgetMB=64, path=None):
+        self.budget = budgetMB*1024*1024
+        self.path = path
+        self.entries = OrderedDict()
+        self.size = 0
+        self.metrics = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def file_name(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.frames')
+
+    def get(self, key):
+        demo = self.entries.get(key)
+        if demo is None and self.path and os.path.exists(self.file_name(key)):
+            try:
+                demo = MappedDemo(self.file_name(key))
+                self.insert(key, demo)
+            except (OSError, ValueError):
+                log.exception('Could not read cached frames from %s', self.file_name(key))
+                demo = None
+        if demo is None:
+            self.metrics['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.metrics['hits'] += 1
+        return demo
+
+    def put(self, key, demo):
+        if demo.nbytes > self.budget:
+            log.warning('Demo frames (%s bytes) exceed the frame cache budget, not cached', demo.nbytes)
+            return
+        if self.path:
+            MappedDemo.save(self.file_name(key), demo)
+            demo = MappedDemo(self.file_name(key))
+        self.metrics['stored'] += 1
+        self.insert(key, demo)
+
+    def insert(self, key, demo):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.nbytes
+            old.close()
+        self.entries[key] = demo
+        self.size += demo.nbytes
+        while self.size > self.budget and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+            evicted.close()
+            self.metrics['evicted'] += 1
+
+    def close(self):
+        for demo in self.entries.values():
+            demo.close()
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return dict(self.metrics, entries=len(self.entries), bytes=self.size)
+
+class DemoRecorder():
+    '''
+    Encodes the frames of a demo for the cache while it is played the first
+    time. Each render is encoded in full and, with delta frames, also as
+    patches against the previous render, in the FrameEncoder's worker pool.
+    Frames come back from collect() in order as (frame, patches).
+    '''
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.delta = None
+        if encoder.delta is not None:
+            # every frame gets patches unless too much of it changed
+            self.delta = DeltaEncoder(keyframeInterval=2**31, blockSize=encoder.delta.blockSize,
+                                      maxDirtyRatio=encoder.delta.maxDirtyRatio)
+        self.settings = encoder.settings()
+        self.pending = deque()
+        self.frames = []
+        self.patches = []
+
+    def add(self, render):
+        render = self.encoder.scale(render)
+        frameFuture = self.encoder.submit(render)
+        patchFuture = None
+        if self.delta is not None:
+            keyframe, patches = self.delta.prepare(render)
+            if not keyframe:
+                patchFuture = self.encoder.submit_patches(patches)
+        self.pending.append((frameFuture, patchFuture))
+
+    async def collect(self, flush=False):
+        '''
+        Returns:
+            - frames (Type: list of (bytes, list of (x, y, bytes) or None))
+        '''
+        limit = 0 if flush else self.encoder.pipelineDepth - 1
+        frames = []
+        while len(self.pending) > limit:
+            frameFuture, patchFuture = self.pending.popleft()
+            frame, seconds = await frameFuture
+            self.encoder.record_encode(seconds)
+            patches = None
+            if patchFuture is not None:
+                patches, _ = await patchFuture
+            self.frames.append(frame)
+            self.patches.append(patches)
+            frames.append((frame, patches))
+        return frames
+
+    def result(self):
+        '''
+        Returns:
+            - demo (Type: CachedDemo, or None if the encoder settings changed
+              while recording, e.g. through the QualityController)
+        '''
+        if self.pending or self.encoder.settings() != self.settings:
+            return None
+        return CachedDemo(self.frames, self.patches)
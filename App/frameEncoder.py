@@ -0,0 +1,343 @@
+'''
+Frame encoding for Trial renders.
+JPEG encoding is the most CPU heavy part of a trial, so it runs in a thread
+or process pool while the event loop steps the next frame. Frames are kept
+as raw bytes; base64 is only applied when a frame is sent inside JSON.
+With frameDelta enabled only the regions that changed since the previous
+render are encoded, with a full keyframe every keyframeInterval frames.
+'''
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+FRAME_FORMATS = ('JPEG', 'WEBP')
+
+def encode_frame(render, frameFormat='JPEG', quality=75):
+    '''
+    Translates the npArray into a jpeg (or webp) image. Module level so it
+    can be pickled into a process pool.
+    Returns:
+        - frame (Type: bytes of the encoded image)
+    '''
+    img = Image.fromarray(render)
+    fp = BytesIO()
+    img.save(fp, frameFormat, quality=quality)
+    frame = fp.getvalue()
+    fp.close()
+    return frame
+
+def encode_patches(patches, frameFormat='JPEG', quality=75):
+    '''
+    Encodes a list of (x, y, npArray) patches.
+    Returns:
+        - patches (Type: list of (x, y, bytes))
+    '''
+    return [(x, y, encode_frame(patch, frameFormat, quality)) for x, y, patch in patches]
+
+def timed(func, *args):
+    '''
+    Runs func in the worker and returns (result, seconds spent), so encode
+    time excludes time spent waiting for a free worker.
+    '''
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+class DeltaEncoder():
+    '''
+    Keeps the previous render and splits each new render into the
+    rectangles that changed. Changes are found per blockSize x blockSize
+    block with one vectorized comparison. Dirty blocks become one bounding
+    box when it is mostly dirty, otherwise runs of dirty blocks in a block
+    row are merged with identical runs in the rows below.
+    A keyframe is used when there is no previous render, every
+    keyframeInterval frames, when one was requested, or when more than
+    maxDirtyRatio of the image changed.
+    '''
+
+    def __init__(self, keyframeInterval=30, blockSize=16, maxDirtyRatio=0.5):
+        self.keyframeInterval = max(1, keyframeInterval)
+        self.blockSize = blockSize
+        self.maxDirtyRatio = maxDirtyRatio
+        self.previous = None
+        self.sinceKeyframe = 0
+        self.forceKeyframe = True
+        self.frames = 0
+        self.keyframes = 0
+        self.bytes = 0
+        self.fullBytes = 0
+        self.keyframeBytes = 0
+
+    def request_keyframe(self):
+        self.forceKeyframe = True
+
+    def reset(self, render):
+        '''
+        Restarts the delta chain from a render that is sent as a keyframe
+        outside of prepare().
+        '''
+        self.store(render)
+        self.sinceKeyframe = 0
+        self.forceKeyframe = False
+
+    def store(self, render):
+        if self.previous is None or self.previous.shape != render.shape:
+            self.previous = np.array(render)
+        else:
+            np.copyto(self.previous, render)
+
+    def dirty_rects(self, render):
+        '''
+        Returns:
+            - rects (Type: list of (x, y, width, height) in pixels)
+            - dirtyRatio (Type: float fraction of blocks that changed)
+        '''
+        bs = self.blockSize
+        h, w = render.shape[:2]
+        changed = render != self.previous
+        if changed.ndim == 3:
+            changed = changed.any(axis=2)
+        rows, cols = -(-h//bs), -(-w//bs)
+        padded = np.zeros((rows*bs, cols*bs), dtype=bool)
+        padded[:h, :w] = changed
+        blocks = padded.reshape(rows, bs, cols, bs).any(axis=(1, 3))
+        dirtyRatio = blocks.mean()
+        if not blocks.any():
+            return [], dirtyRatio
+
+        # every patch pays for its own image header, so one bounding box is
+        # cheaper unless it would mostly cover unchanged blocks
+        rowIdx = np.flatnonzero(blocks.any(axis=1))
+        colIdx = np.flatnonzero(blocks.any(axis=0))
+        y0, y1 = int(rowIdx[0]), int(rowIdx[-1]) + 1
+        x0, x1 = int(colIdx[0]), int(colIdx[-1]) + 1
+        if (y1 - y0)*(x1 - x0) <= 2*blocks.sum():
+            return [(x0*bs, y0*bs, min(x1*bs, w) - x0*bs, min(y1*bs, h) - y0*bs)], dirtyRatio
+
+        # runs of dirty blocks in each block row, as [start, end) column pairs
+        edges = np.diff(np.pad(blocks, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+        rects = []
+        open_rects = {}
+        for row in range(rows):
+            starts = np.flatnonzero(edges[row] == 1)
+            ends = np.flatnonzero(edges[row] == -1)
+            still_open = {}
+            for run in zip(starts.tolist(), ends.tolist()):
+                rect = open_rects.pop(run, None)
+                if rect is None:
+                    rect = [run[0], row, run[1], row + 1]
+                else:
+                    rect[3] = row + 1
+                still_open[run] = rect
+            rects.extend(open_rects.values())
+            open_rects = still_open
+        rects.extend(open_rects.values())
+
+        return [(x0*bs, y0*bs, min(x1*bs, w) - x0*bs, min(y1*bs, h) - y0*bs)
+                for x0, y0, x1, y1 in rects], dirtyRatio
+
+    def prepare(self, render):
+        '''
+        Decides between a keyframe and a patch list for render and updates
+        the previous render.
+        Returns:
+            - keyframe (Type: bool)
+            - patches (Type: list of (x, y, npArray) regions to encode, empty
+              for a keyframe)
+        '''
+        keyframe = (self.forceKeyframe or self.previous is None
+                    or self.previous.shape != render.shape
+                    or self.sinceKeyframe >= self.keyframeInterval)
+        patches = []
+        if not keyframe:
+            rects, dirtyRatio = self.dirty_rects(render)
+            if dirtyRatio > self.maxDirtyRatio:
+                keyframe = True
+            else:
+                patches = [(x, y, render[y:y+h, x:x+w]) for x, y, w, h in rects]
+        if keyframe:
+            self.sinceKeyframe = 0
+            self.forceKeyframe = False
+        else:
+            self.sinceKeyframe += 1
+        self.store(render)
+        return keyframe, patches
+
+    def record(self, keyframe, size):
+        '''
+        Tracks bytes sent, using the latest keyframe size as the estimate of
+        what a full frame would have cost.
+        '''
+        self.frames += 1
+        self.bytes += size
+        if keyframe:
+            self.keyframes += 1
+            self.keyframeBytes = size
+        self.fullBytes += self.keyframeBytes
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'keyframes': self.keyframes,
+            'bytesPerFrame': round(self.bytes/max(self.frames, 1)),
+            'fullBytesPerFrame': round(self.fullBytes/max(self.frames, 1)),
+            'savings': round(1 - self.bytes/self.fullBytes, 3) if self.fullBytes else 0.0,
+        }
+
+def create_executor(pool='thread', workers=2):
+    '''
+    Creates the worker pool frames are encoded in. One pool can be shared
+    by the encoders of many sessions.
+    '''
+    if pool == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+class FrameEncoder():
+    '''
+    Encodes renders in a worker pool. Frames are queued with queue() and
+    collected in order with collect(); at most pipelineDepth frames are in
+    flight, which bounds the latency added by overlapping encode and step.
+    Collected renders hold either the full 'frame' or, for delta frames,
+    the changed 'patches'. quality and downscale (an integer stride) apply
+    to frames queued after they are changed. A shared executor can be
+    passed in, in which case close() leaves it running.
+    '''
+
+    def __init__(self, pool='thread', workers=2, pipelineDepth=2, frameFormat='JPEG',
+                 frameDelta=False, keyframeInterval=30, blockSize=16, executor=None):
+        frameFormat = frameFormat.upper()
+        if frameFormat not in FRAME_FORMATS:
+            raise ValueError(f'frameFormat must be one of {FRAME_FORMATS}, got {frameFormat}')
+        self.frameFormat = frameFormat
+        self.ownsExecutor = executor is None
+        self.executor = executor if executor is not None else create_executor(pool, workers)
+        self.pipelineDepth = max(1, pipelineDepth)
+        self.pipeline = deque()
+        self.delta = DeltaEncoder(keyframeInterval, blockSize) if frameDelta else None
+        self.quality = 75
+        self.downscale = 1
+        self.controller = None
+
+    def submit(self, render):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, timed, encode_frame,
+                                    render, self.frameFormat, self.quality)
+
+    def submit_patches(self, patches):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, timed, encode_patches,
+                                    patches, self.frameFormat, self.quality)
+
+    def scale(self, render):
+        if self.downscale > 1:
+            return render[::self.downscale, ::self.downscale]
+        return render
+
+    def record_encode(self, seconds):
+        if self.controller is not None:
+            self.controller.record_encode(seconds)
+
+    async def encode(self, render):
+        '''
+        Encodes a single full frame immediately. The delta chain restarts
+        from it, so it can be sent as a keyframe.
+        '''
+        render = self.scale(render)
+        if self.delta is not None:
+            self.delta.reset(render)
+        try:
+            frame, seconds = await self.submit(render)
+        except Exception:
+            raise TypeError("Render failed. Is env.render('rgb_array') being called\
+                            With the correct arguement?")
+        self.record_encode(seconds)
+        if self.delta is not None:
+            self.delta.record(True, len(frame))
+        return frame
+
+    def request_keyframe(self):
+        if self.delta is not None:
+            self.delta.request_keyframe()
+
+    def settings(self):
+        '''
+        Returns:
+            - settings (Type: tuple of everything that changes the encoded bytes)
+        '''
+        blockSize = self.delta.blockSize if self.delta is not None else None
+        return (self.frameFormat, self.quality, self.downscale, blockSize)
+
+    def from_cache(self, frameId, frame, patches):
+        '''
+        Picks between the cached full frame and the cached patches with the
+        same keyframe rules as queue(). Cached frames bypass the delta
+        chain, so the next live frame is a keyframe.
+        Returns:
+            - render (Type: dict like the ones returned by collect())
+        '''
+        delta = self.delta
+        if delta is None:
+            return {'frame': frame, 'frameId': frameId}
+        keyframe = (patches is None or delta.forceKeyframe
+                    or delta.sinceKeyframe >= delta.keyframeInterval)
+        delta.previous = None
+        if keyframe:
+            delta.sinceKeyframe = 0
+            delta.forceKeyframe = False
+            delta.record(True, len(frame))
+            return {'frame': frame, 'frameId': frameId}
+        delta.sinceKeyframe += 1
+        delta.record(False, sum(len(patch) for x, y, patch in patches))
+        return {'patches': patches, 'frameId': frameId}
+
+    def queue(self, frameId, render):
+        render = self.scale(render)
+        keyframe, patches = True, None
+        if self.delta is not None:
+            keyframe, patches = self.delta.prepare(render)
+        if keyframe:
+            future = self.submit(render)
+        else:
+            future = self.submit_patches(patches)
+        self.pipeline.append((frameId, keyframe, future))
+
+    async def collect(self, flush=False):
+        '''
+        Waits for the oldest frames until fewer than pipelineDepth remain in
+        flight (none if flush is set).
+        Returns:
+            - renders (Type: list of dicts with frame and frameId, in order)
+        '''
+        limit = 0 if flush else self.pipelineDepth - 1
+        renders = []
+        while len(self.pipeline) > limit:
+            frameId, keyframe, future = self.pipeline.popleft()
+            try:
+                encoded, seconds = await future
+            except Exception:
+                raise TypeError("Render failed. Is env.render('rgb_array') being called\
+                                With the correct arguement?")
+            self.record_encode(seconds)
+            if keyframe:
+                render = {'frame': encoded, 'frameId': frameId}
+                size = len(encoded)
+            else:
+                render = {'patches': encoded, 'frameId': frameId}
+                size = sum(len(patch) for x, y, patch in encoded)
+            if self.delta is not None:
+                self.delta.record(keyframe, size)
+            renders.append(render)
+        return renders
+
+    def stats(self):
+        return self.delta.stats() if self.delta is not None else {}
+
+    def close(self):
+        self.pipeline.clear()
+        if self.ownsExecutor:
+            self.executor.shutdown(wait=False)
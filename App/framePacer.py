@@ -0,0 +1,91 @@
+'''
+Frame pacing for the Trial render loop.
+Replaces time.sleep() between frames with an asyncio.sleep() scheduled
+against the monotonic clock, so the event loop keeps serving the websocket
+while waiting for the next frame.
+'''
+import asyncio
+import time
+
+class FramePacer():
+    '''
+    Schedules frames at a target frame rate. Time already spent rendering and
+    encoding a frame is subtracted from the sleep. When the loop falls a whole
+    frame or more behind, the schedule jumps forward and the number of missed
+    frames is returned so the caller can skip rendering them.
+    '''
+
+    def __init__(self, framerate=30, minFrameRate=1, maxFrameRate=60, stepSize=5):
+        self.minFrameRate = minFrameRate
+        self.maxFrameRate = maxFrameRate
+        self.stepSize = stepSize
+        self.framerate = self.clamp(framerate)
+        self.frames = 0
+        self.droppedFrames = 0
+        self.achievedFrameRate = 0.0
+        self.reset()
+
+    def clamp(self, framerate):
+        return max(self.minFrameRate, min(self.maxFrameRate, framerate))
+
+    def set_framerate(self, framerate):
+        self.framerate = self.clamp(framerate)
+        self.reset()
+        return self.framerate
+
+    def increase(self):
+        return self.set_framerate(self.framerate + self.stepSize)
+
+    def decrease(self):
+        return self.set_framerate(self.framerate - self.stepSize)
+
+    def reset(self):
+        '''
+        Restarts the schedule, e.g. after a pause, so the time spent paused
+        is not counted as frames that fell behind.
+        '''
+        self.deadline = None
+        self.windowStart = time.monotonic()
+        self.windowFrames = 0
+
+    async def wait(self):
+        '''
+        Sleeps until the next frame is due.
+        Returns:
+            - skipped (Type: int number of frames the caller should drop to
+              get back on schedule, 0 when on time)
+        '''
+        now = time.monotonic()
+        interval = 1/self.framerate
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += interval
+        self.count_frame(now)
+
+        skipped = 0
+        delay = self.deadline - now
+        if delay <= -interval:
+            skipped = int(-delay // interval)
+            self.deadline += skipped*interval
+            self.droppedFrames += skipped
+            delay = self.deadline - now
+        # always yield so queued websocket traffic is served between frames
+        await asyncio.sleep(max(delay, 0))
+        return skipped
+
+    def count_frame(self, now):
+        self.frames += 1
+        self.windowFrames += 1
+        elapsed = now - self.windowStart
+        if elapsed >= 1:
+            self.achievedFrameRate = self.windowFrames/elapsed
+            self.windowStart = now
+            self.windowFrames = 0
+
+    def stats(self):
+        return {
+            'targetFrameRate': self.framerate,
+            'achievedFrameRate': round(self.achievedFrameRate, 2),
+            'frames': self.frames,
+            'droppedFrames': self.droppedFrames,
+        }
@@ -0,0 +1,121 @@
+'''
+Logging for trial.py and websocket.py.
+Messages on the render loop's hot path (every frame, every websocket
+message) go through HotPathLogger, which checks the level before doing any
+work, truncates payloads lazily and rate limits per message type. The level
+is read from the HIPPOGYM_LOG_LEVEL environment variable or set from the
+trial config with set_level().
+'''
+import logging
+import os
+import random
+import time
+
+TAG = "\033[1;35m[HIPPOGYM]\033[0m"
+
+_handler = None
+_hotLoggers = []
+
+def get_logger(name):
+    '''
+    Returns the logger for a module, installing the HIPPOGYM handler on the
+    package root logger the first time it is called.
+    '''
+    global _handler
+    root = logging.getLogger('hippogym')
+    if _handler is None:
+        _handler = logging.StreamHandler()
+        _handler.setFormatter(logging.Formatter(f'{TAG} %(levelname)s %(name)s: %(message)s'))
+        root.addHandler(_handler)
+        root.propagate = False
+        set_level(os.environ.get('HIPPOGYM_LOG_LEVEL', 'INFO'))
+    return root.getChild(name)
+
+def set_level(level):
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            level = logging.INFO
+    logging.getLogger('hippogym').setLevel(level)
+
+def configure_hot_path(ratePerSecond=None, payloadLimit=None, sampleRate=None):
+    '''
+    Applies the trial config's logRateLimit/logPayloadLimit/logSampleRate to
+    every HotPathLogger, including the ones created at import by other modules.
+    '''
+    for hotlog in _hotLoggers:
+        if ratePerSecond is not None:
+            hotlog.ratePerSecond = ratePerSecond
+        if sampleRate is not None:
+            hotlog.sampleRate = sampleRate
+        if payloadLimit is not None:
+            hotlog.payloadLimit = payloadLimit
+
+class Truncated():
+    '''
+    Wraps a payload so it is only converted to a (shortened) string if the
+    message is actually emitted.
+    '''
+    __slots__ = ('payload', 'limit')
+
+    def __init__(self, payload, limit=200):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.payload)
+        if len(text) <= self.limit:
+            return text
+        return f'{text[:self.limit]}... ({len(text)} chars)'
+
+class HotPathLogger():
+    '''
+    Logger for high-rate events. Each event has a key (e.g. the route key or
+    message type); a key logs at most ratePerSecond messages a second and
+    only a sampleRate fraction of events are considered at all. The number
+    of suppressed messages is reported with the next one that gets through.
+    Arguments are truncated to payloadLimit characters, and nothing is
+    formatted unless the message is emitted.
+    '''
+
+    def __init__(self, logger, ratePerSecond=5, sampleRate=1.0, payloadLimit=200):
+        self.logger = logger
+        self.ratePerSecond = ratePerSecond
+        self.sampleRate = sampleRate
+        self.payloadLimit = payloadLimit
+        self.windows = {}
+        _hotLoggers.append(self)
+
+    def truncate(self, payload):
+        return Truncated(payload, self.payloadLimit)
+
+    def allow(self, key):
+        if self.sampleRate < 1 and random.random() >= self.sampleRate:
+            return False, 0
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= 1:
+            suppressed = window[2] if window is not None else 0
+            self.windows[key] = [now, 1, 0]
+            return True, suppressed
+        if window[1] < self.ratePerSecond:
+            window[1] += 1
+            return True, 0
+        window[2] += 1
+        return False, 0
+
+    def log(self, level, key, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        allowed, suppressed = self.allow(key)
+        if not allowed:
+            return
+        if suppressed:
+            msg = f'{msg} [{suppressed} similar suppressed]'
+        self.logger.log(level, msg, *(Truncated(arg, self.payloadLimit) for arg in args))
+
+    def debug(self, key, msg, *args):
+        self.log(logging.DEBUG, key, msg, *args)
+
+    def info(self, key, msg, *args):
+        self.log(logging.INFO, key, msg, *args)
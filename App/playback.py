@@ -0,0 +1,202 @@
+'''
+Demo playback for the 'pref' modality.
+A Playback streams the frames of one demo as an async generator, paced by
+the trial's FramePacer, so the trial can run it as a task and keep handling
+commands: it can be paused, resumed, moved to any step with seek() (also
+while paused, to scrub) and cancelled when another demo is started.
+Frames come from the FrameCache when the demo was played before. Otherwise
+the demo is simulated; the environment state is snapshotted every
+snapshotInterval steps (if the Agent supports it) so a seek only replays
+the steps after the closest snapshot, without rendering them. Cached frames
+still step the agent, without rendering, so the transitions it records are
+the same either way.
+'''
+import asyncio
+from frameCache import DemoRecorder
+from hippoLogging import get_logger, HotPathLogger
+
+log = get_logger('playback')
+hotlog = HotPathLogger(log)
+
+class Playback():
+    '''
+    Positions are indexes into the demo's frames: the frame at position p
+    is rendered after p + 1 steps. Rendered frames are yielded as dicts like
+    the ones from FrameEncoder.collect(), with frameId left for the caller.
+    '''
+
+    def __init__(self, agent, actions, encoder, pacer, frameCache=None, key=None, snapshotInterval=30):
+        self.agent = agent
+        self.actions = actions
+        self.encoder = encoder
+        self.pacer = pacer
+        self.frameCache = frameCache
+        self.key = key
+        self.snapshotInterval = max(1, snapshotInterval)
+        self.snapshots = {}
+        self.position = 0
+        self.playing = True
+        self.seekTo = None
+        self.wake = asyncio.Event()
+
+    def __len__(self):
+        return len(self.actions)
+
+    def pause(self):
+        self.playing = False
+
+    def resume(self):
+        if not self.playing:
+            self.playing = True
+            self.pacer.reset()
+            self.wake.set()
+
+    def seek(self, position):
+        self.seekTo = max(0, min(int(position), len(self.actions) - 1))
+        self.wake.set()
+
+    async def idle(self):
+        '''
+        Waits while paused until resume() or seek() is called.
+        '''
+        self.wake.clear()
+        if not self.playing and self.seekTo is None:
+            await self.wake.wait()
+
+    async def frames(self):
+        # frames still in the encoder belong to whatever played before
+        await self.encoder.collect(flush=True)
+        self.encoder.request_keyframe()
+        self.pacer.reset()
+        cached = self.frameCache.get(self.key) if self.key is not None else None
+        source = self.stream(cached) if cached is not None else self.simulate()
+        try:
+            async for render in source:
+                yield render
+        finally:
+            await source.aclose()
+
+    async def stream(self, cached):
+        '''
+        Streams a CachedDemo. Skipped frames only cost a keyframe request.
+        The agent is stepped along (the demo is deterministic, see
+        Trial.frame_cache_key) so it records the demo's transitions.
+        '''
+        self.agent.reset()
+        self.snapshots = {}
+        position, skip, stepped = 0, 0, 0
+        while position < len(cached):
+            if self.seekTo is not None:
+                position, self.seekTo, skip = self.seekTo, None, 0
+                self.encoder.request_keyframe()
+            elif not self.playing:
+                await self.idle()
+                continue
+            if skip:
+                skip -= 1
+                position += 1
+                self.encoder.request_keyframe()
+                continue
+            if stepped != position + 1:
+                stepped, _ = self.fast_forward(stepped, position + 1)
+            yield self.encoder.from_cache(None, cached.frame(position), cached.patches(position))
+            position += 1
+            self.position = position
+            if self.playing:
+                skip = await self.pacer.wait()
+        if stepped < len(cached):
+            self.fast_forward(stepped, len(cached))
+
+    async def simulate(self):
+        '''
+        Steps the agent through the demo, rendering in the encoder pool.
+        An uninterrupted playback is recorded for the FrameCache.
+        '''
+        encoder = self.encoder
+        self.agent.reset()
+        self.snapshots = {}
+        recorder = DemoRecorder(encoder) if self.key is not None else None
+        position, skip, done = 0, 0, False
+        while position < len(self.actions) and not done:
+            if self.seekTo is not None:
+                target, self.seekTo, skip = self.seekTo, None, 0
+                # the recording would have a gap, and queued frames are stale
+                recorder = None
+                await encoder.collect(flush=True)
+                encoder.request_keyframe()
+                position, done = self.fast_forward(position, target)
+                if done:
+                    break
+            elif not self.playing:
+                for render in await encoder.collect(flush=True):
+                    yield render
+                await self.idle()
+                continue
+
+            hotlog.debug('demo_step', 'idx %s out of %s, action %s', position, len(self.actions), self.actions[position])
+            done = self.step(position)
+            position += 1
+            self.position = position
+            if recorder is not None:
+                # every frame is recorded, skipping only applies to sending
+                recorder.add(self.agent.render())
+                for frame, patches in await recorder.collect():
+                    if skip:
+                        skip -= 1
+                        encoder.request_keyframe()
+                        continue
+                    yield encoder.from_cache(None, frame, patches)
+            elif skip and not done:
+                skip -= 1
+                continue
+            else:
+                encoder.queue(None, self.agent.render())
+                for render in await encoder.collect():
+                    yield render
+            if self.playing and not skip and not done:
+                skip = await self.pacer.wait()
+
+        if recorder is None:
+            for render in await encoder.collect(flush=True):
+                yield render
+            return
+        for frame, patches in await recorder.collect(flush=True):
+            yield encoder.from_cache(None, frame, patches)
+        cached = recorder.result()
+        if cached is not None:
+            self.frameCache.put(self.key, cached)
+
+    def step(self, position):
+        done = self.agent.step(self.actions[position])
+        if (position + 1) % self.snapshotInterval == 0 and position + 1 not in self.snapshots:
+            snapshot = self.snapshot()
+            if snapshot is not None:
+                self.snapshots[position + 1] = snapshot
+        return done
+
+    def snapshot(self):
+        snapshot = getattr(self.agent, 'snapshot', None)
+        return snapshot() if snapshot is not None else None
+
+    def fast_forward(self, position, target):
+        '''
+        Brings the environment to target steps without rendering, from the
+        closest snapshot at or before target, from the current position when
+        that is closer, or from a reset.
+        Returns:
+            - position (Type: int steps taken)
+            - done (Type: bool the episode ended before target)
+        '''
+        base = max((step for step in self.snapshots if step <= target), default=0)
+        if position > target or base > position:
+            if base:
+                self.agent.restore(self.snapshots[base])
+            else:
+                self.agent.reset()
+            position = base
+        log.debug('Seeking from step %s to %s', position, target)
+        while position < target:
+            if self.step(position):
+                return position + 1, True
+            position += 1
+        return position, False
@@ -0,0 +1,111 @@
+'''
+Adaptive frame quality for slow participant links.
+The controller watches how long frames take to encode and to send and trades
+jpeg quality, resolution and frame rate against each other so a slow client
+does not build up an unbounded send backlog.
+'''
+import time
+from collections import deque
+
+class QualityController():
+    '''
+    Keeps moving averages of encode and send time per frame and, once per
+    adjustInterval seconds, compares them to the frame budget (1/framerate):
+        - over highWater of the budget: lower quality, then downscale, then
+          lower the frame rate
+        - under lowWater of the budget: undo those steps in reverse order
+    The frame rate is only raised back up to the target rate: the rate the
+    trial started at, or the one the participant last chose (see set_target).
+    '''
+
+    def __init__(self, encoder, pacer, minQuality=30, maxQuality=90, qualityStep=10,
+                 maxDownscale=2, adjustInterval=1.0, highWater=0.8, lowWater=0.4):
+        self.encoder = encoder
+        self.pacer = pacer
+        self.minQuality = minQuality
+        self.maxQuality = maxQuality
+        self.qualityStep = qualityStep
+        self.maxDownscale = maxDownscale
+        self.adjustInterval = adjustInterval
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.targetFrameRate = pacer.framerate
+        self.encoder.quality = max(minQuality, min(maxQuality, encoder.quality))
+        self.encodeTime = 0.0
+        self.sendTime = 0.0
+        self.lastAdjust = time.monotonic()
+        self.decisions = deque(maxlen=20)
+        self.counts = {'degrade': 0, 'upgrade': 0}
+
+    @staticmethod
+    def average(current, sample, weight=0.2):
+        return sample if current == 0 else current + weight*(sample - current)
+
+    def set_target(self, framerate):
+        '''
+        Called when the participant changes the frame rate, so upgrade()
+        does not put the old rate back.
+        '''
+        self.targetFrameRate = framerate
+
+    def record_encode(self, seconds):
+        self.encodeTime = self.average(self.encodeTime, seconds)
+
+    def record_send(self, seconds):
+        self.sendTime = self.average(self.sendTime, seconds)
+        self.adjust()
+
+    def adjust(self):
+        now = time.monotonic()
+        if now - self.lastAdjust < self.adjustInterval:
+            return
+        self.lastAdjust = now
+        load = max(self.encodeTime, self.sendTime)*self.pacer.framerate
+        if load > self.highWater:
+            decision = self.degrade()
+        elif load < self.lowWater:
+            decision = self.upgrade()
+        else:
+            return
+        if decision:
+            self.counts[decision[0]] += 1
+            self.decisions.append({'time': round(now, 3), 'load': round(load, 3),
+                                   'action': decision[0], 'change': decision[1]})
+
+    def degrade(self):
+        encoder = self.encoder
+        if encoder.quality > self.minQuality:
+            encoder.quality = max(self.minQuality, encoder.quality - self.qualityStep)
+            return 'degrade', f'quality {encoder.quality}'
+        if encoder.downscale < self.maxDownscale:
+            encoder.downscale += 1
+            return 'degrade', f'downscale {encoder.downscale}'
+        if self.pacer.framerate > self.pacer.minFrameRate:
+            return 'degrade', f'framerate {self.pacer.decrease()}'
+        return None
+
+    def upgrade(self):
+        encoder = self.encoder
+        if self.pacer.framerate < self.targetFrameRate:
+            framerate = self.pacer.set_framerate(min(self.targetFrameRate,
+                                                     self.pacer.framerate + self.pacer.stepSize))
+            return 'upgrade', f'framerate {framerate}'
+        if encoder.downscale > 1:
+            encoder.downscale -= 1
+            return 'upgrade', f'downscale {encoder.downscale}'
+        if encoder.quality < self.maxQuality:
+            encoder.quality = min(self.maxQuality, encoder.quality + self.qualityStep)
+            return 'upgrade', f'quality {encoder.quality}'
+        return None
+
+    def metrics(self):
+        return {
+            'quality': self.encoder.quality,
+            'downscale': self.encoder.downscale,
+            'framerate': self.pacer.framerate,
+            'encodeMs': round(self.encodeTime*1000, 2),
+            'sendMs': round(self.sendTime*1000, 2),
+            'degrades': self.counts['degrade'],
+            'upgrades': self.counts['upgrade'],
+            'decisions': list(self.decisions),
+        }
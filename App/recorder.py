@@ -0,0 +1,169 @@
+'''
+Append-only log of everything a participant does during a trial.
+Events (steps, preferences, feedback, ...) are serialized as JSON Lines when
+they are recorded and written by a background task every flushInterval
+seconds, in the default executor, so the event loop never waits on the disk.
+The file is fsynced at most every fsyncInterval seconds and when the
+recorder is closed. A crash loses at most the last unsynced events and can
+leave a partial last line, which read_log() skips. A recorder starts a new
+log: an existing file of the same name is truncated when it is first written.
+At the end of the trial compact() turns the log into one JSON document.
+
+The document has a 'version' field, TRIAL_FORMAT_VERSION. Trials/*.json files
+without one are in the format written before the event log (version 1):
+the last 'save' message's data, or {'preference': [demo, preference]} for
+the last preference. load_trial() reads both and returns version 1 files
+in the current shape, with their one event under 'save' or 'preference'.
+'''
+import asyncio
+import json
+import os
+import time
+from hippoLogging import get_logger
+
+log = get_logger('recorder')
+
+TRIAL_FORMAT_VERSION = 2
+
+def read_log(fileName):
+    '''
+    Returns:
+        - events (Type: list of dicts, in the order they were recorded)
+    '''
+    events = []
+    with open(fileName, encoding='utf-8') as infile:
+        for number, line in enumerate(infile, 1):
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                log.warning('Skipping unreadable line %s of %s', number, fileName)
+    return events
+
+def compact(logFile, outFile, **header):
+    '''
+    Writes outFile atomically as one JSON document: the format version and
+    header fields plus, for each kind of event, the list of its events in
+    order, e.g.
+    {'version': 2, 'userId': ..., 'preference': [{'time': ..., 'demo': 3, 'preference': 'good'}]}
+    Returns:
+        - document (Type: bytes written to outFile)
+    '''
+    document = {'version': TRIAL_FORMAT_VERSION}
+    document.update(header)
+    if os.path.exists(logFile):
+        for entry in read_log(logFile):
+            document.setdefault(entry.pop('event', 'unknown'), []).append(entry)
+    data = json.dumps(document, separators=(',', ':'), default=str).encode('utf-8')
+    tmp = f'{outFile}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as outfile:
+        outfile.write(data)
+    os.replace(tmp, outFile)
+    return data
+
+def load_trial(fileName):
+    '''
+    Reads a Trials/*.json file of any version.
+    Returns:
+        - document (Type: dict in the current format, with its version)
+    '''
+    with open(fileName, encoding='utf-8') as infile:
+        document = json.load(infile)
+    if isinstance(document, dict) and 'version' in document:
+        return document
+    preference = document.get('preference') if isinstance(document, dict) else None
+    if isinstance(preference, list) and len(preference) == 2 and len(document) == 1:
+        return {'version': 1, 'preference': [{'demo': preference[0], 'preference': preference[1]}]}
+    return {'version': 1, 'save': [{'data': document}]}
+
+class TrialRecorder():
+    '''
+    record() is cheap and never blocks. The writer task starts with the
+    first event, so the recorder must be used from the event loop.
+    '''
+
+    def __init__(self, fileName, flushInterval=1.0, fsyncInterval=5.0, maxPending=500):
+        self.fileName = fileName
+        self.flushInterval = flushInterval
+        self.fsyncInterval = fsyncInterval
+        self.maxPending = maxPending
+        self.pending = []
+        self.outfile = None
+        self.task = None
+        self.closed = False
+        self.wake = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.lastSync = time.monotonic()
+        self.metrics = {'events': 0, 'writes': 0, 'syncs': 0, 'bytes': 0}
+
+    def record(self, event, **data):
+        if self.closed:
+            log.warning('Recorder for %s is closed, dropping %s event', self.fileName, event)
+            return
+        entry = {'event': event, 'time': time.time()}
+        entry.update(data)
+        # serialized now, the caller may change data afterwards
+        self.pending.append(json.dumps(entry, separators=(',', ':'), default=str) + '\n')
+        self.metrics['events'] += 1
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        if len(self.pending) >= self.maxPending:
+            self.wake.set()
+
+    async def run(self):
+        # runs until close(), which wakes it for a last flush
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flushInterval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except OSError:
+                log.exception('Could not write to %s, retrying', self.fileName)
+
+    async def flush(self, sync=False):
+        async with self.lock:
+            chunk = ''.join(self.pending)
+            self.pending = []
+            if chunk or sync:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.write, chunk, sync)
+                except OSError:
+                    # kept for the next flush
+                    self.pending.insert(0, chunk)
+                    raise
+
+    def write(self, chunk, sync):
+        if self.outfile is None:
+            os.makedirs(os.path.dirname(self.fileName) or '.', exist_ok=True)
+            self.outfile = open(self.fileName, 'w', encoding='utf-8')
+        if chunk:
+            self.outfile.write(chunk)
+            self.outfile.flush()
+            self.metrics['writes'] += 1
+            self.metrics['bytes'] += len(chunk)
+        if sync or time.monotonic() - self.lastSync >= self.fsyncInterval:
+            os.fsync(self.outfile.fileno())
+            self.lastSync = time.monotonic()
+            self.metrics['syncs'] += 1
+
+    async def close(self):
+        '''
+        Writes and syncs the remaining events and closes the file.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        if self.task is not None:
+            # not cancelled, which could drop a chunk being written
+            self.wake.set()
+            await self.task
+        if self.metrics['events']:
+            await self.flush(sync=True)
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+    def stats(self):
+        return dict(self.metrics, pending=len(self.pending))
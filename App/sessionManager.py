@@ -0,0 +1,234 @@
+'''
+Runs many Trials in one process over a single backend websocket connection.
+Inbound messages are routed to a session by their userId; a session is
+created the first time a userId is seen, except for a userId whose session
+ended less than closedSessionGrace seconds ago: messages still in flight
+for it are dropped rather than starting a new session. Every session gets its own Trial,
+Agent and environment, while the config, the websocket connection and the
+frame encoder pool, environment pool, frame cache and uploader are shared.
+Run with: python3 sessionManager.py
+'''
+import asyncio
+import json
+import time
+from trial import Trial, load_config, create_websocket, create_env_pool, create_frame_cache, create_uploader
+from websocket import Websocket
+from frameEncoder import create_executor
+from hippoLogging import get_logger
+
+log = get_logger('sessions')
+
+def done_message(userId, reason):
+    '''
+    The DONE message that turns a participant away, e.g. when the server is full.
+    '''
+    return json.dumps({"action": "DONE", "userId": userId, "sendTo": "frontend", "message": reason})
+
+class SessionSocket(Websocket):
+    '''
+    The websocket as seen by one session. Sends go out on the shared
+    connection with this session's userId, with their own batching and
+    frame slot, and messages routed to the session are read from a bounded
+    inbox (oldest dropped when full).
+    '''
+
+    def __init__(self, connection, userID, inboxSize=100):
+        super().__init__(connection.connection_url, heartbeatInterval=0,
+                         batchWindow=connection.batchWindow, maxBatchSize=connection.maxBatchSize,
+                         coalesceFrames=connection.coalesceFrames)
+        self.connection = connection
+        self.userID = userID
+        self.inbox = asyncio.Queue(maxsize=inboxSize)
+        self.droppedInbound = 0
+
+    @property
+    def websocket(self):
+        return self.connection.websocket
+
+    @websocket.setter
+    def websocket(self, value):
+        pass # the connection is owned by the session manager
+
+    def is_reconnecting(self):
+        return self.connection.is_reconnecting()
+
+    async def send(self, message):
+        await self.connection.send(message)
+
+    async def connectClient(self):
+        pass
+
+    def deliver(self, message):
+        if self.inbox.full():
+            self.inbox.get_nowait()
+            self.droppedInbound += 1
+            log.warning('Inbox full for %s, dropped oldest message', self.userID)
+        self.inbox.put_nowait(message)
+
+    async def recieveData(self):
+        message = await self.inbox.get()
+        if message is None:
+            raise ConnectionError('Session closed')
+        return message
+
+    async def disconnectClient(self):
+        await self.flush()
+        self.closing = True
+        if self.sender is not None:
+            self.sender.cancel()
+            self.sender = None
+        self.deliver(None)
+
+class Session():
+    def __init__(self, socket, trial):
+        self.socket = socket
+        self.trial = trial
+        self.task = None
+
+class RecentlyClosed():
+    '''
+    The userIds whose session ended less than grace seconds ago.
+    '''
+
+    def __init__(self, grace):
+        self.grace = grace
+        self.closedAt = {} # userId: time.monotonic() it was closed, oldest first
+
+    def add(self, userId):
+        if self.grace > 0:
+            self.closedAt.pop(userId, None)
+            self.closedAt[userId] = time.monotonic()
+
+    def expire(self):
+        deadline = time.monotonic() - self.grace
+        while self.closedAt:
+            userId, closedAt = next(iter(self.closedAt.items()))
+            if closedAt > deadline:
+                break
+            del self.closedAt[userId]
+
+    def __contains__(self, userId):
+        self.expire()
+        return userId in self.closedAt
+
+class SessionManager():
+    '''
+    Owns the shared connection, encoder pool, environment pool, frame cache
+    and uploader. A connection can be passed in, e.g. the queues to the supervisor when
+    running as a worker. Caps:
+        - maxSessions concurrent sessions, further users are sent DONE
+        - sessionInboxSize queued inbound messages per session
+        - maxSessionMinutes before a session is ended
+        - closedSessionGrace seconds a closed session's userId is not reopened
+    '''
+
+    def __init__(self, config=None, connection=None):
+        self.config = config if config is not None else load_config()
+        self.connection = connection if connection is not None else create_websocket(self.config)
+        self.executor = create_executor(self.config.get('encoderPool', 'thread'),
+                                        self.config.get('encoderWorkers', 2))
+        self.envPool = create_env_pool(self.config)
+        self.frameCache = create_frame_cache(self.config)
+        self.uploader = create_uploader(self.config)
+        self.maxSessions = self.config.get('maxSessions', 8)
+        self.inboxSize = self.config.get('sessionInboxSize', 100)
+        self.maxSessionMinutes = self.config.get('maxSessionMinutes')
+        self.sessions = {}
+        self.recentlyClosed = RecentlyClosed(self.config.get('closedSessionGrace', 10))
+        if isinstance(self.connection, Websocket):
+            self.connection.onReconnect = self.request_keyframes
+
+    def request_keyframes(self):
+        '''
+        After a reconnect every session starts again from a keyframe.
+        '''
+        for session in self.sessions.values():
+            session.socket.request_keyframe()
+
+    async def connect(self):
+        await self.connection.connectClient()
+        if self.connection.websocket is not None:
+            await self.run()
+
+    async def run(self):
+        log.info('Session manager running, up to %s sessions', self.maxSessions)
+        try:
+            while True:
+                message = await self.connection.recieveData()
+                await self.route(message)
+        except ConnectionError as e:
+            log.error('Connection lost: %s', e)
+        finally:
+            await self.shutdown()
+
+    async def route(self, message):
+        userId = message.get('userId')
+        if userId is None:
+            log.debug('Dropping message without userId: %s', message)
+            return
+        session = self.sessions.get(userId)
+        if session is None:
+            if userId in self.recentlyClosed:
+                log.debug('Dropping message for closed session %s: %s', userId, message)
+                return
+            session = await self.open_session(userId)
+            if session is None:
+                return
+        session.socket.deliver(message)
+
+    async def open_session(self, userId):
+        if len(self.sessions) >= self.maxSessions:
+            log.warning('At capacity (%s sessions), turning away %s', self.maxSessions, userId)
+            await self.connection.send(done_message(userId, 'server full'))
+            return None
+        socket = SessionSocket(self.connection, userId, self.inboxSize)
+        session = Session(socket, Trial(self.config, socket, self.executor, self.envPool, self.frameCache, self.uploader))
+        self.sessions[userId] = session
+        session.task = asyncio.ensure_future(self.run_session(userId, session))
+        log.info('Opened session for %s (%s active)', userId, len(self.sessions))
+        return session
+
+    async def run_session(self, userId, session):
+        trial = session.trial
+        try:
+            if self.maxSessionMinutes:
+                await asyncio.wait_for(trial.start(), self.maxSessionMinutes*60)
+            else:
+                await trial.start()
+        except asyncio.TimeoutError:
+            log.warning('Session for %s reached maxSessionMinutes', userId)
+            await trial.end()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            log.exception('Session for %s failed', userId)
+        finally:
+            self.sessions.pop(userId, None)
+            self.recentlyClosed.add(userId)
+            trial.done = True
+            trial.encoder.close()
+            if hasattr(trial, 'agent'):
+                trial.agent.close()
+            await session.socket.disconnectClient()
+            log.info('Closed session for %s (%s active)', userId, len(self.sessions))
+
+    async def shutdown(self):
+        tasks = [session.task for session in self.sessions.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+        if self.envPool is not None:
+            self.envPool.close()
+        if self.frameCache is not None:
+            self.frameCache.close()
+        if self.uploader is not None:
+            await self.uploader.close(self.config.get('uploadTimeout', 60))
+        await self.connection.disconnectClient()
+
+async def main():
+    manager = SessionManager()
+    await manager.connect()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,365 @@
+'''
+Runs Trial sessions in several worker processes, by default one per core,
+so Gym stepping, agent updates and frame encoding are not limited to one
+core by the GIL.
+The supervisor owns the backend websocket connection and acts as the router:
+a new userId is assigned to the least loaded worker and every message for
+that userId is forwarded to it over a multiprocessing queue. Each worker
+runs a SessionManager whose connection is the pair of queues to the
+supervisor. Workers report a heartbeat with their session count; a worker
+that exits or stops reporting is replaced and its participants are sent
+DONE. On SIGINT/SIGTERM workers are drained: they stop taking participants
+and exit once their sessions have ended or drainTimeout has passed.
+Run with: python3 supervisor.py
+'''
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from trial import load_config, create_websocket
+from sessionManager import SessionManager, RecentlyClosed, done_message
+from hippoLogging import get_logger
+
+log = get_logger('supervisor')
+
+class WorkerConnection():
+    '''
+    The connection as seen by a worker's SessionManager. Sends are put on the
+    queue the supervisor forwards to the websocket; when that queue is full
+    send waits, so frames back up (and are coalesced) in the sessions.
+    Control messages (heartbeats, closed sessions) wait the same way with
+    notify(), or, where the caller cannot wait, are retried in the
+    background by put(), which never raises.
+    '''
+
+    def __init__(self, index, inbox, outbox, config):
+        self.index = index
+        self.inbox = inbox
+        self.outbox = outbox
+        self.websocket = outbox
+        self.connection_url = None
+        self.batchWindow = config.get('batchWindow', 0.01)
+        self.maxBatchSize = config.get('maxBatchSize', 20)
+        self.coalesceFrames = config.get('coalesceFrames', True)
+        self.pendingPuts = set()
+
+    def is_reconnecting(self):
+        return False
+
+    def put(self, kind, payload):
+        try:
+            self.outbox.put_nowait((self.index, kind, payload))
+        except queue.Full:
+            task = asyncio.ensure_future(self.notify(kind, payload))
+            self.pendingPuts.add(task)
+            task.add_done_callback(self.pendingPuts.discard)
+
+    async def notify(self, kind, payload):
+        while True:
+            try:
+                self.outbox.put_nowait((self.index, kind, payload))
+                return
+            except queue.Full:
+                await asyncio.sleep(0.005)
+
+    async def send(self, message):
+        await self.notify('send', message)
+
+    async def receive(self):
+        '''
+        Returns:
+            - item (Type: tuple of kind, 'message', 'drain' or 'reconnected', and payload)
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return await loop.run_in_executor(None, self.inbox.get, True, 0.5)
+            except queue.Empty:
+                pass
+
+    async def disconnectClient(self, timeout=5):
+        # gives the messages put() is still retrying timeout seconds to go out
+        if self.pendingPuts:
+            await asyncio.wait(list(self.pendingPuts), timeout=timeout)
+
+class WorkerSessions(SessionManager):
+    '''
+    The SessionManager run inside a worker process. Besides routing it
+    reports heartbeats and closed sessions to the supervisor, and on a drain
+    request stops opening sessions and returns once the open ones end.
+    '''
+
+    def __init__(self, config, connection):
+        super().__init__(config, connection)
+        self.heartbeatInterval = self.config.get('workerHeartbeatInterval', 2)
+        self.draining = False
+        self.drained = asyncio.Event()
+
+    async def run(self):
+        log.info('Worker %s running, up to %s sessions', self.connection.index, self.maxSessions)
+        heartbeat = asyncio.ensure_future(self.send_heartbeats())
+        receiver = asyncio.ensure_future(self.receive())
+        try:
+            await self.drained.wait()
+        finally:
+            heartbeat.cancel()
+            receiver.cancel()
+            await self.shutdown()
+
+    async def receive(self):
+        while True:
+            kind, payload = await self.connection.receive()
+            if kind == 'message':
+                await self.route(payload)
+            elif kind == 'drain':
+                asyncio.ensure_future(self.drain(payload))
+            elif kind == 'reconnected':
+                self.request_keyframes()
+
+    async def drain(self, timeout):
+        self.draining = True
+        log.info('Worker %s draining %s sessions', self.connection.index, len(self.sessions))
+        deadline = time.monotonic() + timeout
+        while self.sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self.drained.set()
+
+    async def send_heartbeats(self):
+        while True:
+            await self.connection.notify('heartbeat', len(self.sessions))
+            await asyncio.sleep(self.heartbeatInterval)
+
+    async def open_session(self, userId):
+        if self.draining:
+            await self.connection.send(done_message(userId, 'server shutting down'))
+            await self.connection.notify('closed', userId)
+            return None
+        session = await super().open_session(userId)
+        if session is None:
+            await self.connection.notify('closed', userId)
+        return session
+
+    async def run_session(self, userId, session):
+        try:
+            await super().run_session(userId, session)
+        finally:
+            # put() does not raise or wait, so the session's own exit stands
+            self.connection.put('closed', userId)
+
+def run_worker(index, config, inbox, outbox):
+    '''
+    Entry point of a worker process. Signals are left to the supervisor,
+    which drains the workers itself.
+    '''
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    asyncio.run(serve_worker(index, config, inbox, outbox))
+
+async def serve_worker(index, config, inbox, outbox):
+    # built inside the running loop, so the asyncio objects of the sessions
+    # bind to it and not to a loop inherited from the supervisor (Python 3.7)
+    connection = WorkerConnection(index, inbox, outbox, config)
+    await WorkerSessions(config, connection).run()
+
+class Worker():
+    def __init__(self, index, process, inbox):
+        self.index = index
+        self.process = process
+        self.inbox = inbox
+        self.users = set()
+        self.sessions = 0
+        self.lastHeartbeat = time.monotonic()
+
+class Supervisor():
+    '''
+    Starts the workers, routes participants to them and keeps them healthy.
+    Settings:
+        - workers processes, 0 for one per core
+        - maxSessions per worker, further participants are sent DONE
+        - workerTimeout seconds without a heartbeat before a worker is restarted
+        - drainTimeout seconds workers get to finish their sessions on shutdown
+        - routerQueueSize outbound messages queued from the workers
+    '''
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else load_config()
+        self.connection = create_websocket(self.config)
+        self.numWorkers = self.config.get('workers', 0) or os.cpu_count() or 1
+        self.maxSessions = self.config.get('maxSessions', 8)
+        self.workerTimeout = self.config.get('workerTimeout', 30)
+        self.drainTimeout = self.config.get('drainTimeout', 60)
+        self.healthInterval = self.config.get('workerHeartbeatInterval', 2)
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self.outbox = self.context.Queue(self.config.get('routerQueueSize', 256))
+        self.workers = []
+        self.assignments = {}
+        self.recentlyClosed = RecentlyClosed(self.config.get('closedSessionGrace', 10))
+        self.draining = False
+        self.stopping = asyncio.Event()
+        self.restarts = 0
+        self.connection.onReconnect = self.notify_reconnect
+
+    def start_worker(self, index):
+        inbox = self.context.Queue()
+        process = self.context.Process(target=run_worker, name=f'hippogym-worker-{index}',
+                                       args=(index, self.config, inbox, self.outbox), daemon=True)
+        process.start()
+        worker = Worker(index, process, inbox)
+        if index < len(self.workers):
+            self.workers[index] = worker
+        else:
+            self.workers.append(worker)
+        log.info('Started worker %s (pid %s)', index, process.pid)
+        return worker
+
+    async def connect(self):
+        for index in range(self.numWorkers):
+            self.start_worker(index)
+        await self.connection.connectClient()
+        if self.connection.websocket is not None:
+            await self.run()
+        else:
+            await self.drain(0)
+
+    def stop(self):
+        log.info('Shutdown requested')
+        self.stopping.set()
+
+    async def run(self):
+        log.info('Supervisor running %s workers, up to %s sessions each',
+                 self.numWorkers, self.maxSessions)
+        forwarder = asyncio.ensure_future(self.forward())
+        health = asyncio.ensure_future(self.check_health())
+        receiver = asyncio.ensure_future(self.receive())
+        stopping = asyncio.ensure_future(self.stopping.wait())
+        try:
+            await asyncio.wait([receiver, stopping], return_when=asyncio.FIRST_COMPLETED)
+            # with the connection gone there is nothing to wait for
+            await self.drain(0 if receiver.done() else self.drainTimeout)
+        finally:
+            for task in (forwarder, health, receiver, stopping):
+                task.cancel()
+            await self.connection.disconnectClient()
+
+    async def receive(self):
+        try:
+            while True:
+                message = await self.connection.recieveData()
+                await self.route(message)
+        except ConnectionError as e:
+            log.error('Connection lost: %s', e)
+
+    async def route(self, message):
+        userId = message.get('userId')
+        if userId is None:
+            log.debug('Dropping message without userId: %s', message)
+            return
+        index = self.assignments.get(userId)
+        if index is None:
+            if userId in self.recentlyClosed:
+                log.debug('Dropping message for closed session %s: %s', userId, message)
+                return
+            worker = self.least_loaded()
+            if worker is None:
+                reason = 'server shutting down' if self.draining else 'server full'
+                log.warning('Turning away %s: %s', userId, reason)
+                await self.connection.send(done_message(userId, reason))
+                return
+            worker.users.add(userId)
+            self.assignments[userId] = index = worker.index
+            log.info('Assigned %s to worker %s (%s sessions)', userId, index, len(worker.users))
+        self.workers[index].inbox.put(('message', message))
+
+    def least_loaded(self):
+        if self.draining:
+            return None
+        workers = [worker for worker in self.workers
+                   if worker.process.is_alive() and len(worker.users) < self.maxSessions]
+        return min(workers, key=lambda worker: len(worker.users), default=None)
+
+    def notify_reconnect(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.inbox.put(('reconnected', None))
+
+    async def forward(self):
+        '''
+        Sends the workers' messages on the websocket and records their
+        heartbeats and closed sessions.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                index, kind, payload = await loop.run_in_executor(None, self.outbox.get, True, 0.5)
+            except queue.Empty:
+                continue
+            if kind == 'send':
+                await self.connection.send(payload)
+            elif kind == 'heartbeat':
+                self.workers[index].lastHeartbeat = time.monotonic()
+                self.workers[index].sessions = payload
+            elif kind == 'closed':
+                self.release(payload, index)
+
+    def release(self, userId, index):
+        if self.assignments.get(userId) == index:
+            del self.assignments[userId]
+            self.recentlyClosed.add(userId)
+        self.workers[index].users.discard(userId)
+
+    async def check_health(self):
+        while True:
+            await asyncio.sleep(self.healthInterval)
+            if self.draining:
+                continue
+            now = time.monotonic()
+            for worker in list(self.workers):
+                alive = worker.process.is_alive()
+                if alive and now - worker.lastHeartbeat < self.workerTimeout:
+                    continue
+                if alive:
+                    log.error('Worker %s missed heartbeats for %.0fs, restarting',
+                              worker.index, now - worker.lastHeartbeat)
+                    worker.process.kill()
+                else:
+                    log.error('Worker %s exited with code %s, restarting',
+                              worker.index, worker.process.exitcode)
+                worker.process.join(1)
+                worker.inbox.cancel_join_thread()
+                for userId in list(worker.users):
+                    self.release(userId, worker.index)
+                    await self.connection.send(done_message(userId, 'session lost'))
+                self.restarts += 1
+                self.start_worker(worker.index)
+
+    async def drain(self, timeout):
+        self.draining = True
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.inbox.put(('drain', timeout))
+        # a few seconds on top of the workers' own deadline to shut down cleanly
+        deadline = time.monotonic() + timeout + 5
+        while (any(worker.process.is_alive() for worker in self.workers)
+               and time.monotonic() < deadline):
+            await asyncio.sleep(0.1)
+        for worker in self.workers:
+            if worker.process.is_alive():
+                log.warning('Worker %s did not drain in time, terminating', worker.index)
+                worker.process.terminate()
+            worker.process.join(1)
+            worker.inbox.cancel_join_thread()
+        log.info('All workers stopped (%s restarts)', self.restarts)
+
+async def main():
+    supervisor = Supervisor()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, supervisor.stop)
+    await supervisor.connect()
+
+if __name__ == '__main__':
+    asyncio.run(main())
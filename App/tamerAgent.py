@@ -4,127 +4,11 @@ from code provided by Calarina Muslimani of the Intelligent Robot Learning Labor
 To use this code with the default setup simply rename this file to agent.py
 '''
 
-import gym
 import time
 import numpy as np
 import itertools
-
-
-#This is the code for tile coding features
-basehash = hash
-
-class IHT:
-    "Structure to handle collisions"
-    def __init__(self, sizeval):
-        self.size = sizeval                        
-        self.overfullCount = 0
-        self.dictionary = {}
-
-    def __str__(self):
-        "Prepares a string for printing whenever this object is printed"
-        return "Collision table:" +                " size:" + str(self.size) +                " overfullCount:" + str(self.overfullCount) +                " dictionary:" + str(len(self.dictionary)) + " items"
-
-    def count (self):
-        return len(self.dictionary)
-    
-    def fullp (self):
-        return len(self.dictionary) >= self.size
-    
-    def getindex (self, obj, readonly=False):
-        d = self.dictionary
-        if obj in d: return d[obj]
-        elif readonly: return None
-        size = self.size
-        count = self.count()
-        if count >= size:
-            if self.overfullCount==0: print('IHT full, starting to allow collisions')
-            self.overfullCount += 1
-            return basehash(obj) % self.size
-        else:
-            d[obj] = count
-            return count
-
-def hashcoords(coordinates, m, readonly=False):
-    if type(m)==IHT: return m.getindex(tuple(coordinates), readonly)
-    if type(m)==int: return basehash(tuple(coordinates)) % m
-    if m==None: return coordinates
-
-from math import floor, log
-from itertools import zip_longest
-
-def tiles (ihtORsize, numtilings, floats, ints=[], readonly=False):
-    """returns num-tilings tile indices corresponding to the floats and ints"""
-    qfloats = [floor(f*numtilings) for f in floats]
-    Tiles = []
-    for tiling in range(numtilings):
-        tilingX2 = tiling*2
-        coords = [tiling]
-        b = tiling
-        for q in qfloats:
-            coords.append( (q + b) // numtilings )
-            b += tilingX2
-        coords.extend(ints)
-        Tiles.append(hashcoords(coords, ihtORsize, readonly))
-    return Tiles
-
-def tileswrap (ihtORsize, numtilings, floats, wrapwidths, ints=[], readonly=False):
-    """returns num-tilings tile indices corresponding to the floats and ints, wrapping some floats"""
-    qfloats = [floor(f*numtilings) for f in floats]
-    Tiles = []
-    for tiling in range(numtilings):
-        tilingX2 = tiling*2
-        coords = [tiling]
-        b = tiling
-        for q, width in zip_longest(qfloats, wrapwidths):
-            c = (q + b%numtilings) // numtilings
-            coords.append(c%width if width else c)
-            b += tilingX2
-        coords.extend(ints)
-        Tiles.append(hashcoords(coords, ihtORsize, readonly))
-    return Tiles
-
-
-class MountainCarTileCoder:
-    def __init__(self, iht_size=4096, num_tilings=8, num_tiles=8):
-        """
-            Initializes the MountainCar Tile Coder
-            
-            iht_size -- int, the size of the index hash table, typically a power of 2
-            num_tilings -- int, the number of tilings
-            num_tiles -- int, the number of tiles. Here both the width and height of the
-            tile coder are the same
-            """
-        self.iht = IHT(iht_size)
-        self.num_tilings = num_tilings
-        self.num_tiles = num_tiles
-            
-    def get_tiles(self, position, velocity):
-        """
-            Takes in a position and velocity from the mountaincar environment
-            and returns a numpy array of active tiles.
-            
-            returns:
-            tiles - np.array, active tiles
-            """
-        # Use the ranges above and self.num_tiles to scale position and velocity to the range [0, 1]
-        # then multiply that range with self.num_tiles so it scales from [0, num_tiles]
-        minP=-1.2
-        maxP=.5
-        minV=-.07
-        maxV=.07
-        scaleP= maxP- minP
-        scaleV= maxV-minV
-        
-        position_scaled = ((position-minP)/(scaleP))*self.num_tiles
-        
-        velocity_scaled = ((velocity-minV)/(scaleV))*self.num_tiles
-        
-        
-        # get the tiles using tc.tiles, with self.iht, self.num_tilings and [scaled position, scaled velocity]
-        # nothing to implment here
-        mytiles = tiles(self.iht, self.num_tilings, [position_scaled, velocity_scaled])
-        
-        return np.array(mytiles)
+from tileCoding import MountainCarTileCoder
+from experienceBuffer import ExperienceBuffer
 
 
 #this is the tamer agent class
@@ -134,7 +18,7 @@ class TamerAgent:
         Initialization of Tamer Agent. All values are set to None so they can
         be initialized in the agent_init method.
         """
-    def __init__(self):
+    def __init__(self, num_actions=3):
         
         
         self.last_action = None
@@ -149,11 +33,11 @@ class TamerAgent:
         self.epsilon = 0.01
         self.x = .08
         self.alpha =self.x/self.num_tilings  #this is step size
-        self.num_actions = 3
+        self.num_actions = num_actions
         self.actions = list(range(self.num_actions))
         self.time_step=0
-        self.experiences= list()
         self.max_n_experiences=1000
+        self.experiences= ExperienceBuffer(self.max_n_experiences)
         self.window_size=1
         
         
@@ -162,11 +46,13 @@ class TamerAgent:
         self.w = np.ones((self.num_actions, self.iht_size))
         
         # We initialize self.mctc to the mountaincar verions of the
-        # tile coder that we created
+        # tile coder that we created. Its position/velocity grid is bounded, so
+        # tiles are indexed directly, without a hash table or collisions
         
         self.mctc = MountainCarTileCoder(iht_size=self.iht_size,
                                          num_tilings=self.num_tilings,
-                                         num_tiles=self.num_tiles)
+                                         num_tiles=self.num_tiles,
+                                         direct=True)
     
     def argmax(self, q_values):
         """argmax with random tie-breaking
@@ -175,18 +61,11 @@ class TamerAgent:
             Returns:
             action (int): an action with the highest value
             """
-        top = float("-inf")
-        ties = []
-        
-        for i in range(len(q_values)):
-            if q_values[i] > top:
-                top = q_values[i]
-                ties = []
-            
-            if q_values[i] == top:
-                ties.append(i)
-        
-        return np.random.choice(ties)
+        q_values = np.asarray(q_values)
+        ties = np.flatnonzero(q_values == q_values.max())
+        # one draw per call, like np.random.choice(ties) always made, so
+        # seeded runs pick the same actions; randint draws the same, for less
+        return ties[np.random.randint(len(ties))]
 
     def select_greedy_action(self, tiles):
         """
@@ -197,13 +76,10 @@ class TamerAgent:
             (chosen_action, action_value) - (int, float), tuple of the chosen action
             and it's value
             """
-        action_values = []
         chosen_action = None
         
-        for a in range(self.num_actions):
-            action_values.append(np.sum(self.w[a][tiles]))
-        # First loop through the weights of each action and populate action_values
-        # with the action value for each action and tiles instance
+        # the value of each action is the sum of its weights for the active tiles
+        action_values = self.w[:, tiles].sum(axis=1)
         
         if np.random.random() < self.epsilon:
             chosen_action = np.random.choice(self.actions)
@@ -236,7 +112,7 @@ class TamerAgent:
         self.current_action = np.random.choice(self.actions)
         self.current_tiles= np.copy(active_tiles)
         
-        self.experiences.append((self.current_action, self.current_tiles, time.time()))
+        self.experiences.add(self.current_action, self.current_tiles, time.time())
         return self.current_action
 
     
@@ -254,36 +130,41 @@ class TamerAgent:
 
 
         current_time = time.time()
-        while len(self.experiences) > 0:
-            experience = self.experiences[0]
-            
-            #diff= current_time-experience[2]
-
-            #if (diff < .2 or diff > 2):
-            
-            if experience[2] < current_time - self.window_size: #
-                self.experiences.pop(0)
-            
-            else:
-                break
+        # drop the experiences older than the window
+        self.experiences.expire(current_time - self.window_size)
 
 # update weights using Algorithm 1 in paper
         n_experiences = len(self.experiences)
 
         if n_experiences== 0:
             return
-        weight_per_experience = 1.0/n_experiences
-        cred_features = np.zeros((self.num_actions, self.iht_size))
-            
-        for experience in self.experiences:
-            exp_features= np.zeros((self.num_actions, self.iht_size))
-            exp_features[experience[0]][experience[1]]=1
-            
-            exp_features*=weight_per_experience
-            cred_features = np.add(cred_features, exp_features)
-            
-        error = r - self.w * cred_features
-        self.w += (.01*error*cred_features)
+        # only the weights with credit change, the others have a zero update
+        indices, credit = self.credit_features()
+        actions, tiles = np.divmod(indices, self.iht_size)
+        error = r - self.w[actions, tiles] * credit
+        self.w[actions, tiles] += (.01*error*credit)
+
+    def credit_features(self):
+        """
+            Sparse credit features of the experiences in the window: each
+            experience gives 1/n_experiences to every (action, tile) it touched.
+            Returns:
+            (indices, credit) - (np.array, np.array), indices of the credited
+            weights in the flattened self.w and their credit
+            """
+        weight_per_experience = 1.0/len(self.experiences)
+        actions = self.experiences.window_actions()
+        flat = np.sort(self.experiences.window_tiles(), axis=1)
+        flat += actions[:, None]*self.iht_size
+        # an experience credits each of its tiles once, even if two tilings
+        # hashed to the same tile
+        weights = np.full(flat.shape, weight_per_experience)
+        weights[:, 1:][flat[:, 1:] == flat[:, :-1]] = 0
+        indices, inverse = np.unique(flat, return_inverse=True)
+        # bincount adds the weights in experience order, like summing dense
+        # credit arrays did, so the credit is the same to the last bit
+        credit = np.bincount(inverse.reshape(-1), weights=weights.reshape(-1), minlength=len(indices))
+        return indices, credit
 
 
 # Original HIPPO Gym Agent
@@ -305,22 +186,27 @@ class Agent():
     Use this class as a convenient place to store agent state.
     '''
 
-    def start(self, game:str):
+    def start(self, game:str, pool=None):
         '''
-        Starts an OpenAI gym environment.
+        Starts an OpenAI gym environment, taken from the trial's EnvPool when
+        one is given.
         Caller:
             - Trial.start()
         Inputs:
             -   game (Type: str corresponding to allowable gym environments)
+            -   pool (Type: EnvPool of pre-created environments, optional)
         Returs:
             - env (Type: OpenAI gym Environment as returned by gym.make())
             Mandatory
         '''
+        import gym # only the wrapper needs gym, TamerAgent can be used without it
         self.tamer = true
         if self.tamer:
             np.random.seed(0)
-            self.tamerAgent = TamerAgent()
-        self.env = gym.make(game)
+        self.pool = pool if pool is not None and pool.game == game else None
+        self.env = self.pool.acquire() if self.pool is not None else gym.make(game)
+        if self.tamer:
+            self.tamerAgent = TamerAgent(num_actions=self.env.action_space.n)
         return
 
     def step(self, action, reward):
@@ -359,7 +245,7 @@ class Agent():
 
         if self.tamer:
             self.tamerAgent.action_selection(observation)
-            self.tamerAgent.experiences.append((self.tamerAgent.current_action, self.tamerAgent.current_tiles, time.time()))
+            self.tamerAgent.experiences.add(self.tamerAgent.current_action, self.tamerAgent.current_tiles, time.time())
         return envState
 
     def render(self):
@@ -393,7 +279,8 @@ class Agent():
 
     def close(self):
         '''
-        Closes the environment at the end of the trial.
+        Closes the environment at the end of the trial, or gives it back to
+        the pool it came from.
         Caller:
             - Trial.close()
         Inputs:
@@ -401,5 +288,8 @@ class Agent():
         Returns:
             No Return
         '''
-        self.env.close()
+        if self.pool is not None:
+            self.pool.release(self.env)
+        else:
+            self.env.close()
 
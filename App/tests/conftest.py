@@ -0,0 +1,8 @@
+'''
+The App modules import each other by their flat module names, as they do
+when run from App/ or in the Docker image.
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
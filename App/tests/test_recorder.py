@@ -0,0 +1,38 @@
+'''
+The compacted Trials/*.json document and reading the files written before it.
+'''
+import asyncio
+import json
+from recorder import TRIAL_FORMAT_VERSION, TrialRecorder, compact, load_trial
+
+def record(logFile, *events):
+    async def write():
+        recorder = TrialRecorder(logFile)
+        for event, data in events:
+            recorder.record(event, **data)
+        await recorder.close()
+    asyncio.run(write())
+
+def write_json(path, document):
+    with open(path, 'w') as outfile:
+        json.dump(document, outfile)
+    return str(path)
+
+def test_compact_groups_events_under_version(tmp_path):
+    logFile = str(tmp_path / 'p_u.jsonl')
+    record(logFile, ('start', {'trialId': 't'}), ('preference', {'demo': 3, 'preference': 'good'}),
+           ('preference', {'demo': 4, 'preference': 'bad'}))
+    compact(logFile, str(tmp_path / 'p_u.json'), userId='u')
+    document = load_trial(str(tmp_path / 'p_u.json'))
+    assert document['version'] == TRIAL_FORMAT_VERSION and document['userId'] == 'u'
+    assert [(e['demo'], e['preference']) for e in document['preference']] == [(3, 'good'), (4, 'bad')]
+    assert document['start'][0]['trialId'] == 't'
+
+def test_loads_old_preference_file(tmp_path):
+    document = load_trial(write_json(tmp_path / 'old.json', {'preference': [3, 'good']}))
+    assert document == {'version': 1, 'preference': [{'demo': 3, 'preference': 'good'}]}
+
+def test_loads_old_save_file(tmp_path):
+    saved = {'score': 10, 'preference': 'left'}
+    document = load_trial(write_json(tmp_path / 'old.json', saved))
+    assert document == {'version': 1, 'save': [{'data': saved}]}
@@ -0,0 +1,87 @@
+'''
+TamerAgent.update_reward_function only updates the credited weights. These
+tests check it against the dense update it replaced.
+'''
+import math
+import numpy as np
+import pytest
+from tamerAgent import TamerAgent
+
+REWARDS = {'good': 1, 'bad': -1, 'reallygood': 4}
+
+def dense_update(agent, r):
+    # the update as it was written before it was made sparse
+    weight_per_experience = 1.0/len(agent.experiences)
+    cred_features = np.zeros((agent.num_actions, agent.iht_size))
+    for experience in agent.experiences:
+        exp_features = np.zeros((agent.num_actions, agent.iht_size))
+        exp_features[experience[0]][experience[1]] = 1
+        exp_features *= weight_per_experience
+        cred_features = np.add(cred_features, exp_features)
+    error = r - agent.w*cred_features
+    agent.w += .01*error*cred_features
+
+def make_agents(experiences):
+    dense, sparse = TamerAgent(), TamerAgent()
+    for agent in (dense, sparse):
+        agent.window_size = math.inf
+        for experience in experiences:
+            agent.experiences.add(*experience)
+    return dense, sparse
+
+def random_experiences(rng, agent, count):
+    states = np.column_stack((rng.uniform(-1.2, .6, count), rng.uniform(-.07, .07, count)))
+    return [(int(rng.integers(agent.num_actions)), agent.mctc.get_tiles(position, velocity), float(step))
+            for step, (position, velocity) in enumerate(states.tolist())]
+
+@pytest.mark.parametrize('window', [1, 2, 30, 300])
+def test_sparse_update_matches_dense(window):
+    rng = np.random.default_rng(window)
+    dense, sparse = make_agents(random_experiences(rng, TamerAgent(), window))
+    for reward in ['good', 'bad', 'reallygood', 'None', 'good']*4:
+        if reward != 'None':
+            dense_update(dense, REWARDS[reward])
+        sparse.update_reward_function(reward)
+    assert np.array_equal(dense.w, sparse.w)
+
+def test_duplicate_tile_index_is_credited_once():
+    rng = np.random.default_rng(0)
+    experiences = random_experiences(rng, TamerAgent(), 5)
+    # two tilings on the same tile, as a full IHT can hash them
+    duplicate = experiences[2][1].copy()
+    duplicate[3] = duplicate[6]
+    experiences[2] = (experiences[2][0], duplicate, experiences[2][2])
+    dense, sparse = make_agents(experiences)
+    for reward in ['good', 'bad', 'reallygood']:
+        dense_update(dense, REWARDS[reward])
+        sparse.update_reward_function(reward)
+    assert np.array_equal(dense.w, sparse.w)
+
+def test_no_feedback_leaves_weights():
+    rng = np.random.default_rng(1)
+    _, sparse = make_agents(random_experiences(rng, TamerAgent(), 10))
+    sparse.update_reward_function('None')
+    assert np.array_equal(sparse.w, np.ones_like(sparse.w))
+
+def loop_argmax(q_values):
+    # argmax as it was written before it was vectorized
+    top = float("-inf")
+    ties = []
+    for i in range(len(q_values)):
+        if q_values[i] > top:
+            top = q_values[i]
+            ties = []
+        if q_values[i] == top:
+            ties.append(i)
+    return np.random.choice(ties)
+
+def test_argmax_keeps_the_seeded_random_stream():
+    agent = TamerAgent(num_actions=4)
+    rng = np.random.default_rng(0)
+    # with and without ties, between epsilon draws like select_greedy_action makes
+    values = [rng.integers(0, 3, 4).astype(float) for _ in range(200)]
+    choices = []
+    for argmax in (loop_argmax, agent.argmax):
+        np.random.seed(0)
+        choices.append([(np.random.random(), int(argmax(q))) for q in values])
+    assert choices[0] == choices[1]
@@ -0,0 +1,94 @@
+'''
+The Uploader with a FileBackend: uploads, retries, and the spool that keeps
+failed uploads and uploads left by a crashed process.
+'''
+import asyncio
+import json
+import os
+from uploader import FileBackend, Uploader, process_alive
+
+class FlakyBackend(FileBackend):
+    def __init__(self, root, failures):
+        super().__init__(root)
+        self.failures = failures
+
+    def upload(self, fileName, key):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('upload failed')
+        super().upload(fileName, key)
+
+def write_file(path, data='x'*1000):
+    with open(path, 'w') as outfile:
+        outfile.write(data)
+    return str(path)
+
+def dead_pid():
+    pid = 999999
+    while process_alive(pid):
+        pid -= 1
+    return pid
+
+def spool_entry(spool, entry, key, owner=None):
+    # an entry as spool_file() leaves it, claimed by owner if given
+    write_file(os.path.join(spool, entry + '.data'), key)
+    name = entry + '.json' + (f'.{owner}' if owner is not None else '')
+    with open(os.path.join(spool, name), 'w') as outfile:
+        json.dump({'key': key}, outfile)
+
+def run(uploader, *files):
+    async def upload():
+        uploader.start()
+        for fileName, key in files:
+            await uploader.submit(fileName, key)
+        await uploader.close(5)
+    asyncio.run(upload())
+    return uploader.stats()
+
+def test_file_backend_copies_to_key(tmp_path):
+    source = write_file(tmp_path / 'trial.json', 'data')
+    FileBackend(str(tmp_path / 'bucket')).upload(source, 'project/trial.json')
+    assert (tmp_path / 'bucket' / 'project' / 'trial.json').read_text() == 'data'
+    assert os.listdir(tmp_path / 'bucket' / 'project') == ['trial.json']
+
+def test_upload_empties_spool(tmp_path):
+    source = write_file(tmp_path / 'trial.json')
+    spool = str(tmp_path / 'spool')
+    stats = run(Uploader(FileBackend(str(tmp_path / 'bucket')), spool), (source, None))
+    assert stats['uploaded'] == 1 and stats['bytes'] == 1000
+    assert os.listdir(tmp_path / 'bucket') == ['trial.json']
+    assert os.listdir(spool) == []
+    # the submitted file itself is left alone
+    assert os.path.exists(source)
+
+def test_failed_upload_is_retried(tmp_path):
+    source = write_file(tmp_path / 'trial.json')
+    uploader = Uploader(FlakyBackend(str(tmp_path / 'bucket'), 2), str(tmp_path / 'spool'), backoff=0.01)
+    stats = run(uploader, (source, 'trial.json'))
+    assert stats['retries'] == 2 and stats['uploaded'] == 1
+    assert os.listdir(tmp_path / 'bucket') == ['trial.json']
+
+def test_upload_that_keeps_failing_stays_spooled_and_resumes(tmp_path):
+    source = write_file(tmp_path / 'trial.json')
+    spool = str(tmp_path / 'spool')
+    failing = Uploader(FlakyBackend(str(tmp_path / 'bucket'), 100), spool, retries=1, backoff=0.01)
+    stats = run(failing, (source, 'trial.json'))
+    assert stats['failed'] == 1 and stats['uploaded'] == 0
+    assert len(os.listdir(spool)) == 2
+    # the next uploader, e.g. after a restart, uploads what was left
+    stats = run(Uploader(FileBackend(str(tmp_path / 'bucket')), spool))
+    assert stats['resumed'] == 1 and stats['uploaded'] == 1
+    assert os.listdir(tmp_path / 'bucket') == ['trial.json']
+    assert os.listdir(spool) == []
+
+def test_claims_only_entries_no_live_process_owns(tmp_path):
+    spool = str(tmp_path / 'spool')
+    os.makedirs(spool)
+    spool_entry(spool, 'unclaimed', 'a.json')
+    spool_entry(spool, 'crashed', 'b.json', owner=dead_pid())
+    spool_entry(spool, 'running', 'c.json', owner=os.getppid())
+    stats = run(Uploader(FileBackend(str(tmp_path / 'bucket')), spool))
+    assert stats['resumed'] == 2
+    assert sorted(os.listdir(tmp_path / 'bucket')) == ['a.json', 'b.json']
+    # still owned by the live process
+    assert sorted(os.listdir(spool)) == ['running.data', f'running.json.{os.getppid()}']
@@ -0,0 +1,225 @@
+'''
+Tile coding shared by the TAMER and COACH agents.
+IHT, tiles() and tileswrap() are Rich Sutton's tile coding software (tiles3),
+kept for compatibility. TileCoder computes the same tiles for all tilings,
+and for a batch of states, at once with NumPy integer arithmetic. It either
+hashes the tile coordinates through an IHT, giving the same indices as
+tiles(), or, for states on a bounded grid, maps them directly to
+collision-free indices without any dictionary.
+'''
+from math import ceil, floor
+from itertools import zip_longest
+import numpy as np
+
+basehash = hash
+
+class IHT:
+    "Structure to handle collisions"
+    def __init__(self, sizeval):
+        self.size = sizeval
+        self.overfullCount = 0
+        self.dictionary = {}
+
+    def __str__(self):
+        "Prepares a string for printing whenever this object is printed"
+        return "Collision table:" + " size:" + str(self.size) + " overfullCount:" + str(self.overfullCount) + " dictionary:" + str(len(self.dictionary)) + " items"
+
+    def count (self):
+        return len(self.dictionary)
+
+    def fullp (self):
+        return len(self.dictionary) >= self.size
+
+    def getindex (self, obj, readonly=False):
+        d = self.dictionary
+        if obj in d: return d[obj]
+        elif readonly: return None
+        size = self.size
+        count = self.count()
+        if count >= size:
+            if self.overfullCount==0: print('IHT full, starting to allow collisions')
+            self.overfullCount += 1
+            return basehash(obj) % self.size
+        else:
+            d[obj] = count
+            return count
+
+def hashcoords(coordinates, m, readonly=False):
+    if type(m)==IHT: return m.getindex(tuple(coordinates), readonly)
+    if type(m)==int: return basehash(tuple(coordinates)) % m
+    if m==None: return coordinates
+
+def tiles (ihtORsize, numtilings, floats, ints=[], readonly=False):
+    """returns num-tilings tile indices corresponding to the floats and ints"""
+    qfloats = [floor(f*numtilings) for f in floats]
+    Tiles = []
+    for tiling in range(numtilings):
+        tilingX2 = tiling*2
+        coords = [tiling]
+        b = tiling
+        for q in qfloats:
+            coords.append( (q + b) // numtilings )
+            b += tilingX2
+        coords.extend(ints)
+        Tiles.append(hashcoords(coords, ihtORsize, readonly))
+    return Tiles
+
+def tileswrap (ihtORsize, numtilings, floats, wrapwidths, ints=[], readonly=False):
+    """returns num-tilings tile indices corresponding to the floats and ints, wrapping some floats"""
+    qfloats = [floor(f*numtilings) for f in floats]
+    Tiles = []
+    for tiling in range(numtilings):
+        tilingX2 = tiling*2
+        coords = [tiling]
+        b = tiling
+        for q, width in zip_longest(qfloats, wrapwidths):
+            c = (q + b%numtilings) // numtilings
+            coords.append(c%width if width else c)
+            b += tilingX2
+        coords.extend(ints)
+        Tiles.append(hashcoords(coords, ihtORsize, readonly))
+    return Tiles
+
+class TileCoder():
+    '''
+    Tiles of states with dims float coordinates, already scaled so one tile
+    is 1 wide. Tiling t is offset by t*(1 + 2d)/numTilings in dimension d,
+    like in tiles(), so the coordinate of a state in tiling t and dimension d
+    is (floor(x[d]*numTilings) + t*(1 + 2d)) // numTilings.
+    Without a grid, coordinates are hashed through an IHT of ihtSize (the
+    same indices tiles() returns for the same IHT and call order). With grid,
+    the number of tiles in each dimension, states are assumed to lie in
+    [0, grid[d]] (coordinates outside are clipped) and every tile gets its
+    own index, so size is exact and there are no collisions. The index is
+    then a sum over dimensions of a precomputed table row per quantized
+    coordinate, so no dictionary is involved.
+    encode() takes one state or a batch; for one state NumPy's per-call
+    overhead outweighs the arithmetic on numTilings*dims numbers, so a
+    hashed state goes through tiles() and a grid state is quantized with
+    Python integers instead.
+    '''
+
+    def __init__(self, numTilings, dims=None, ihtSize=4096, grid=None):
+        self.numTilings = numTilings
+        self.grid = None if grid is None else np.asarray(grid, dtype=np.int64)
+        self.dims = len(self.grid) if self.grid is not None else dims
+        if not self.dims:
+            raise ValueError('TileCoder needs dims or grid')
+        # offset of tiling t in dimension d, in 1/numTilings of a tile
+        self.offsets = np.arange(numTilings)[:, None]*(1 + 2*np.arange(self.dims))[None, :]
+        if self.grid is None:
+            self.iht = IHT(ihtSize)
+            self.size = ihtSize
+            self.tilingIds = np.arange(numTilings)[:, None]
+            return
+        self.iht = None
+        # the largest coordinate is grid plus the largest offset in whole tiles
+        widths = self.grid + 1 + self.offsets[-1]//numTilings
+        strides = np.append(np.cumprod(widths[::-1])[::-1][1:], 1)
+        tilingSize = int(np.prod(widths))
+        self.size = numTilings*tilingSize
+        self.qMax = (self.grid*numTilings).tolist()
+        # tables[d][q] is what dimension d adds to the index of each tiling
+        # for the quantized coordinate q = floor(x[d]*numTilings)
+        self.tables = [((np.arange(top + 1)[:, None] + self.offsets[:, d])//numTilings)*strides[d]
+                       for d, top in enumerate(self.qMax)]
+        self.tables[0] += np.arange(numTilings, dtype=np.int64)*tilingSize
+
+    def coordinates(self, floats):
+        '''
+        Inputs:
+            - floats (Type: array of shape (dims,) or (batch, dims))
+        Returns:
+            - coordinates (Type: int64 npArray of shape (..., numTilings, dims))
+        '''
+        q = np.floor(np.asarray(floats, dtype=np.float64)*self.numTilings).astype(np.int64)
+        return (q[..., None, :] + self.offsets)//self.numTilings
+
+    def encode(self, floats):
+        '''
+        Returns:
+            - tiles (Type: int64 npArray of shape (numTilings,) for one state,
+              (batch, numTilings) for a batch)
+        '''
+        if np.ndim(floats) == 1:
+            return self.encode_state(floats)
+        if self.grid is not None:
+            q = np.floor(np.asarray(floats, dtype=np.float64)*self.numTilings).astype(np.int64)
+            q = np.clip(q, 0, self.qMax)
+            tiles = self.tables[0][q[:, 0]]
+            for d in range(1, self.dims):
+                tiles += self.tables[d][q[:, d]]
+            return tiles
+        coords = self.coordinates(floats)
+        shape = coords.shape[:-1]
+        keys = np.concatenate((np.broadcast_to(self.tilingIds, shape + (1,)), coords), axis=-1)
+        getindex = self.iht.getindex
+        indices = [getindex(tuple(key)) for key in keys.reshape(-1, self.dims + 1).tolist()]
+        return np.array(indices, dtype=np.int64).reshape(shape)
+
+    def encode_state(self, floats):
+        numTilings = self.numTilings
+        if self.grid is None:
+            return np.array(tiles(self.iht, numTilings, floats), dtype=np.int64)
+        qs = [min(max(floor(f*numTilings), 0), top) for f, top in zip(floats, self.qMax)]
+        indices = self.tables[0][qs[0]].copy()
+        for table, q in zip(self.tables[1:], qs[1:]):
+            indices += table[q]
+        return indices
+
+class MountainCarTileCoder:
+    def __init__(self, iht_size=4096, num_tilings=8, num_tiles=8, direct=False):
+        """
+            Initializes the MountainCar Tile Coder
+
+            iht_size -- int, the size of the index hash table, typically a power of 2
+            num_tilings -- int, the number of tilings
+            num_tiles -- int, the number of tiles. Here both the width and height of the
+            tile coder are the same
+            direct -- bool, index the tiles of the bounded position/velocity grid
+            directly instead of hashing them, needs iht_size >= self.coder.size
+            """
+        self.num_tilings = num_tilings
+        self.num_tiles = num_tiles
+        # num_tiles tiles span positions up to 0.5 (the goal), as the agents
+        # always scaled them, but positions go up to 0.6
+        self.low = np.array([-1.2, -.07])
+        self.span = np.array([.5, .07]) - self.low
+        self.bounds = self.low.tolist() + self.span.tolist()
+        if direct:
+            grid = [ceil(num_tiles*(.6 - self.low[0])/self.span[0]), num_tiles]
+            self.coder = TileCoder(num_tilings, grid=grid)
+            if self.coder.size > iht_size:
+                raise ValueError(f'{self.coder.size} tiles do not fit in iht_size {iht_size}')
+        else:
+            self.coder = TileCoder(num_tilings, dims=2, ihtSize=iht_size)
+        self.iht = self.coder.iht
+
+    def get_tiles(self, position, velocity):
+        """
+            Takes in a position and velocity from the mountaincar environment
+            and returns a numpy array of active tiles.
+
+            returns:
+            tiles - np.array, active tiles
+            """
+        # scale position and velocity to [0, num_tiles]
+        minP, minV, scaleP, scaleV = self.bounds
+        scaled = [((position - minP)/scaleP)*self.num_tiles, ((velocity - minV)/scaleV)*self.num_tiles]
+        if self.iht is not None:
+            # the call the agents always made, the fastest for one hashed state
+            return np.array(tiles(self.iht, self.num_tilings, scaled))
+        return self.coder.encode_state(scaled)
+
+    def get_tiles_batch(self, states):
+        """
+            Active tiles of many (position, velocity) states at once.
+
+            returns:
+            tiles - np.array of shape (len(states), num_tilings)
+            """
+        return self.coder.encode(self.scale(np.asarray(states, dtype=np.float64)))
+
+    def scale(self, states):
+        # position and velocity scaled to [0, num_tiles], in the same order of operations as before
+        return ((states - self.low)/self.span)*self.num_tiles
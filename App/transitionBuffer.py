@@ -0,0 +1,167 @@
+'''
+Columnar storage for the transitions an Agent records.
+Every column is a preallocated NumPy array that doubles when full, so
+recording a step copies a few values instead of allocating new arrays.
+Observations are stored once: an episode of T steps has T + 1 observation
+rows (the first observation and every next observation), and the next_obs
+of a step is simply the following row.
+'''
+import numpy as np
+
+COLUMNS = ('obs', 'action', 'reward', 'next_obs', 'dones')
+
+class TransitionBuffer():
+    '''
+    Step columns (action int8, reward float32, dones bool, episode int32)
+    have one row per step. Observation rows of episode e (0-based) that
+    covers steps [start, end) are [start + e, end + e + 1).
+    Reading buffer['obs'] etc. like the old dict of lists returns arrays
+    over all steps; episode() returns zero-copy views of one episode.
+    Views stay valid but stop seeing new steps once the buffer grows.
+    '''
+
+    def __init__(self, capacity=1024, obsDtype=np.float32, actionDtype=np.int8):
+        self.capacity = capacity
+        self.obsDtype = obsDtype
+        self.action = np.zeros(capacity, dtype=actionDtype)
+        self.reward = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.episodeIds = np.zeros(capacity, dtype=np.int32)
+        self.obs = None # allocated on the first step, when the observation shape is known
+        self.steps = 0
+        self.obsRows = 0
+        self.episodeStarts = []
+        self.open = False
+
+    @classmethod
+    def from_columns(cls, columns):
+        '''
+        Wraps columns as returned by columns(), e.g. memory-mapped from an
+        episode archive, without copying them. Recording more steps copies
+        the columns into memory first.
+        '''
+        buffer = cls.__new__(cls)
+        buffer.obsDtype = columns['obs'].dtype
+        buffer.action = columns['action']
+        buffer.reward = columns['reward']
+        buffer.dones = columns['dones']
+        buffer.steps = buffer.capacity = len(buffer.action)
+        buffer.obsRows = len(columns['obs'])
+        buffer.obs = columns['obs'] if buffer.obsRows else None
+        buffer.episodeStarts = np.asarray(columns['episodeStarts']).tolist()
+        lengths = np.diff(np.append(buffer.episodeStarts, buffer.steps))
+        buffer.episodeIds = np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+        buffer.open = False
+        return buffer
+
+    def columns(self):
+        '''
+        Returns:
+            - columns (Type: dict of column name to a view of the recorded
+              rows: obs (T + 1 rows per episode), action, reward, dones and
+              episodeStarts, the first step of each episode)
+        '''
+        return {
+            'obs': self.obs[:self.obsRows] if self.obs is not None else np.zeros(0, dtype=self.obsDtype),
+            'action': self.action[:self.steps],
+            'reward': self.reward[:self.steps],
+            'dones': self.dones[:self.steps],
+            'episodeStarts': np.array(self.episodeStarts, dtype=np.int64),
+        }
+
+    @staticmethod
+    def grow(array, size):
+        grown = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def reserve(self, steps, obsRows):
+        if steps > self.capacity:
+            self.capacity = max(steps, 2*self.capacity)
+            self.action = self.grow(self.action, self.capacity)
+            self.reward = self.grow(self.reward, self.capacity)
+            self.dones = self.grow(self.dones, self.capacity)
+            self.episodeIds = self.grow(self.episodeIds, self.capacity)
+        if obsRows > len(self.obs):
+            self.obs = self.grow(self.obs, max(obsRows, 2*len(self.obs)))
+
+    def end_episode(self):
+        '''
+        Makes the next add() start a new episode, e.g. after a reset that
+        was not caused by a done step.
+        '''
+        self.open = False
+
+    def add(self, obs, action, reward, next_obs, done):
+        '''
+        Records one step. obs is only stored when the step starts an episode,
+        otherwise it is the previous step's next_obs.
+        '''
+        if self.obs is None:
+            shape = np.shape(next_obs)
+            self.obs = np.zeros((self.capacity + 1,) + shape, dtype=self.obsDtype)
+        if self.steps == self.capacity or self.obsRows + 2 > len(self.obs):
+            self.reserve(self.steps + 1, self.obsRows + 2)
+        if not self.open:
+            self.obs[self.obsRows] = obs
+            self.obsRows += 1
+            self.episodeStarts.append(self.steps)
+            self.open = True
+        step = self.steps
+        self.action[step] = action
+        self.reward[step] = reward
+        self.dones[step] = done
+        self.episodeIds[step] = len(self.episodeStarts) - 1
+        self.obs[self.obsRows] = next_obs
+        self.obsRows += 1
+        self.steps += 1
+        if done:
+            self.open = False
+
+    def __len__(self):
+        return self.steps
+
+    def episodes(self):
+        return len(self.episodeStarts)
+
+    def episode(self, idx):
+        '''
+        Returns:
+            - episode (Type: dict of column name to a view of that episode's rows)
+        '''
+        start = self.episodeStarts[idx]
+        end = self.episodeStarts[idx + 1] if idx + 1 < len(self.episodeStarts) else self.steps
+        first = start + idx
+        return {
+            'obs': self.obs[first:first + end - start],
+            'action': self.action[start:end],
+            'reward': self.reward[start:end],
+            'next_obs': self.obs[first + 1:first + 1 + end - start],
+            'dones': self.dones[start:end],
+        }
+
+    def obs_rows(self):
+        return np.arange(self.steps) + self.episodeIds[:self.steps]
+
+    def __getitem__(self, column):
+        if column == 'obs':
+            return self.obs[self.obs_rows()] if self.steps else np.zeros(0, dtype=self.obsDtype)
+        if column == 'next_obs':
+            return self.obs[self.obs_rows() + 1] if self.steps else np.zeros(0, dtype=self.obsDtype)
+        if column == 'action':
+            return self.action[:self.steps]
+        if column == 'reward':
+            return self.reward[:self.steps]
+        if column == 'dones':
+            return self.dones[:self.steps]
+        raise KeyError(column)
+
+    def __contains__(self, column):
+        return column in COLUMNS
+
+    def keys(self):
+        return list(COLUMNS)
+
+    def nbytes(self):
+        columns = (self.action, self.reward, self.dones, self.episodeIds)
+        return sum(column.nbytes for column in columns) + (self.obs.nbytes if self.obs is not None else 0)
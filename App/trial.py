@@ -1,12 +1,17 @@
-import numpy, json, shortuuid, time, base64, yaml, logging, os, xml.etree.ElementTree as ET, errno
+import json, shortuuid, base64, yaml, os
 from websocket import Websocket
+from framePacer import FramePacer
+from frameEncoder import FrameEncoder
+from qualityController import QualityController
+from envPool import EnvPool
+from frameCache import FrameCache, cache_key
+from playback import Playback
+from recorder import TrialRecorder, compact
+from episodeArchive import save_archive
+from transitionBuffer import TransitionBuffer
+from uploader import Uploader, S3Backend, FileBackend
+from hippoLogging import get_logger, set_level, configure_hot_path, HotPathLogger
 import asyncio
-import json
-import os
-import boto3
-from agent import Agent # this is the Agent/Environment combo provided by the researcher
-from PIL import Image
-from io import BytesIO
 
 """Press Start
 Shows first demo.
@@ -16,21 +21,84 @@ Right arrow or right UI button, gives previous demo. But have to press start to
 
 TAG = "\033[1;35m[HIPPOGYM]\033[0m" 
 
+log = get_logger('trial')
+hotlog = HotPathLogger(log)
+
+FRAME_MODES = ['json', 'binary'] # offered to the frontend in send_ui, 'json' until it picks one
+
 def load_config():
-    print(f'{TAG} Loading config from .trialConfig.yml...')
+    log.info('Loading config from .trialConfig.yml...')
     with open('.trialConfig.yml', 'r') as infile:
         config = yaml.load(infile, Loader=yaml.FullLoader)
-    print(f'{TAG} Config loaded')
+    log.info('Config loaded')
     return config.get('trial')
 
+def create_websocket(config):
+    return Websocket( # If you wish to specify your own websocket server use it as param
+        maxRetries=config.get('connectRetries', 5),
+        heartbeatInterval=config.get('heartbeatInterval', 30),
+        outboxSize=config.get('outboxSize', 100),
+        batchWindow=config.get('batchWindow', 0.01),
+        maxBatchSize=config.get('maxBatchSize', 20),
+        coalesceFrames=config.get('coalesceFrames', True))
+
+def create_env_pool(config):
+    '''
+    Creates and warms the EnvPool for the configured game, or returns None
+    when envPoolSize is 0.
+    '''
+    size = config.get('envPoolSize', 0)
+    if not size or not config.get('game'):
+        return None
+    pool = EnvPool(config.get('game'), size)
+    pool.warm()
+    return pool
+
+def create_frame_cache(config):
+    '''
+    Creates the FrameCache for demo playback, or returns None when
+    frameCacheMB is 0.
+    '''
+    budget = config.get('frameCacheMB', 0)
+    if not budget:
+        return None
+    return FrameCache(budget, config.get('frameCachePath') or None)
+
+def create_uploader(config):
+    '''
+    Creates the Uploader for trial data, or returns None when s3upload is
+    not set. uploadBackend 's3' uploads to the config's bucket, any other
+    value is a directory the files are copied to instead.
+    '''
+    if not config.get('s3upload'):
+        return None
+    backend = config.get('uploadBackend', 's3')
+    if backend == 's3':
+        backend = S3Backend(config.get('bucket'), config.get('uploadMultipartMB', 8))
+    else:
+        backend = FileBackend(backend)
+    return Uploader(backend, config.get('uploadSpool', 'Trials/spool'),
+                    retries=config.get('uploadRetries', 5))
+
 class Trial():
-    def __init__(self):
-        print(f'{TAG} Initializing Trial...')
-        self.config = load_config()
+    def __init__(self, config=None, websocket=None, executor=None, envPool=None, frameCache=None, uploader=None):
+        '''
+        By default a Trial loads .trialConfig.yml and owns its websocket,
+        encoder pool, frame cache and uploader, and makes its one environment
+        itself. A session manager running many trials in one process passes
+        in the shared config, a per-session websocket and the shared executor,
+        EnvPool, FrameCache and Uploader instead.
+        '''
+        log.info('Initializing Trial...')
+        self.config = config if config is not None else load_config()
+        if self.config.get('logLevel'):
+            set_level(self.config.get('logLevel'))
+        configure_hot_path(self.config.get('logRateLimit'), self.config.get('logPayloadLimit'),
+                           self.config.get('logSampleRate'))
         self.trialData = None
         self.data = None
         self.count = 1
-        self.websocket = Websocket() # If you wish to specify your own websocket server use it as param
+        self.websocket = websocket if websocket is not None else create_websocket(self.config)
         self.episode = 0
         self.done = False
         self.play = False
@@ -44,16 +112,51 @@ class Trial():
         self.demo_idx = 1
         self.action = 0
         self.modality = self.config.get('modality')
-        self.framerate = self.config.get('startingFrameRate', 30)
+        self.pacer = FramePacer(
+            framerate=self.config.get('startingFrameRate', 30),
+            minFrameRate=self.config.get('minFrameRate', 1),
+            maxFrameRate=self.config.get('maxFrameRate', 60),
+            stepSize=self.config.get('frameRateStepSize', 5))
+        self.skipFrames = 0
+        self.encoder = FrameEncoder(
+            pool=self.config.get('encoderPool', 'thread'),
+            workers=self.config.get('encoderWorkers', 2),
+            pipelineDepth=self.config.get('encoderPipelineDepth', 2),
+            frameFormat=self.config.get('frameFormat', 'JPEG'),
+            frameDelta=self.config.get('frameDelta', False),
+            keyframeInterval=self.config.get('keyframeInterval', 30),
+            executor=executor)
+        self.controller = None
+        if self.config.get('adaptiveQuality'):
+            self.controller = QualityController(self.encoder, self.pacer,
+                minQuality=self.config.get('minJpegQuality', 30),
+                maxQuality=self.config.get('maxJpegQuality', 90),
+                maxDownscale=self.config.get('maxDownscale', 2))
+            self.encoder.controller = self.controller
+            self.websocket.onFrameSent = self.controller.record_send
+        self.websocket.onFrameDropped = self.encoder.request_keyframe
+        self.frameMode = 'json'
         self.frameId = 0
+        self.humanfeedback = 'None'
+        self.messages = asyncio.Queue()
+        self.playback = None
+        self.playbackTask = None
+        self.envPool = envPool # only worth warming when environments are reused between sessions
+        self.frameCache = frameCache if frameCache is not None else create_frame_cache(self.config)
+        self.recorder = None # created once the userId is known, see create_recorder()
+        self.recordSteps = self.config.get('recordSteps', True)
+        self.ownsUploader = uploader is None
+        self.uploader = uploader if uploader is not None else create_uploader(self.config)
         
     async def connect(self):
         await self.websocket.connectClient()
         if self.websocket.websocket is not None:
-            print(f"{TAG} Connected to WebSocket address")
+            log.info('Connected to WebSocket address')
             await self.start()
 
     async def start(self):
+        if self.uploader is not None:
+            self.uploader.start() # also resumes uploads a crash left in the spool
         self.start_trial()
         await self.run()
 
@@ -65,14 +168,14 @@ class Trial():
         By default this expects the openAI Gym Environment object to be
         returned. 
         '''
-        print(f'{TAG} Starting trial...')
+        log.info('Starting trial...')
 
         if self.modality == 'feedback':
             from tamerAgent import TamerAgent
             self.agent = TamerAgent()
 
         elif self.modality == 'pref':
-            from agent import Agent
+            from agent import Agent # this is the Agent/Environment combo provided by the researcher
             self.agent = Agent()
 
         elif self.modality == 'demo':
@@ -80,34 +183,87 @@ class Trial():
             self.agent = Agent()
 
 
-        self.agent.start(self.config.get('game'))
+        if self.envPool is not None:
+            self.agent.start(self.config.get('game'), pool=self.envPool)
+        else:
+            self.agent.start(self.config.get('game'))
         actionSpace = self.config.get('actionSpace')
         self.agent.reset()
 
     async def run(self):
         '''
         This is the main event controlling function for a Trial.
-        It handles the render-step loop
+        Inbound messages are consumed by a separate task into self.messages
+        so the render-step loop advances at the pacer frame rate whether or not
+        the browser is sending anything.
         '''
-        print(f'{TAG} Running trial...')
-        while not self.done:
-            message = await self.websocket.recieveData()
-            await self.handle_message(message)
-            if self.play:
-                if self.modality == 'pref':
-                    await self.render_policy()
-                else:
-                    render = await self.get_render()
-                    await self.send_render(render)
-                    self.take_step()
-                    time.sleep(1/self.framerate)
+        log.info('Running trial...')
+        receiver = asyncio.create_task(self.receive_messages())
+        try:
+            await self.render_loop()
+        finally:
+            receiver.cancel()
+            await self.stop_playback()
+            await self.save_data()
+
+    async def receive_messages(self):
+        '''
+        Reads messages from the websocket into self.messages until the trial
+        is done. If the connection fails the trial is marked done and the
+        render loop is woken up so it can exit.
+        '''
+        try:
+            while not self.done:
+                message = await self.websocket.recieveData()
+                await self.messages.put(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error('Websocket receive failed: %s', e)
+            self.done = True
+            await self.messages.put({})
+
+    async def handle_pending_messages(self):
+        '''
+        Handles every message queued since the last frame without waiting.
+        '''
+        while not self.messages.empty():
+            await self.handle_message(self.messages.get_nowait())
 
+    async def render_loop(self):
+        '''
+        Fixed-rate render-step loop. While paused it sleeps on the message
+        queue instead of spinning. Frames the pacer reports as missed are
+        stepped without being rendered. Each frame is encoded in the encoder
+        pool while the next step is taken.
+        '''
+        while not self.done:
+            await self.handle_pending_messages()
+            if self.done:
+                break
+            if self.modality == 'pref':
+                # demos are played by their own task, see render_policy()
+                await self.handle_message(await self.messages.get())
+                continue
+            if not self.play:
+                await self.send_renders(flush=True)
+                await self.handle_message(await self.messages.get())
+                continue
+            if self.skipFrames:
+                self.skipFrames -= 1
+                await self.take_step()
+            else:
+                self.queue_render()
+                await self.take_step()
+                await self.send_renders()
+                self.skipFrames = await self.pacer.wait()
 
     async def check_done(self):
         '''
         Check if self.done is set to True. If so, save the data and disconnect from the websocket.
         '''
         if self.done:
+            self.encoder.close()
             await self.websocket.disconnectClient()
 
     async def reset(self):
@@ -122,7 +278,18 @@ class Trial():
             await self.end()
         else:
             self.episode += 1
-            print(f'{TAG} self.episode has been incremented...', self.episode)
+            log.info('self.episode has been incremented... %s', self.episode)
+
+    def get_metrics(self):
+        '''
+        Frame pacing, frame size and adaptive quality metrics for this trial.
+        '''
+        metrics = {'frameRate': self.pacer.stats(), 'websocket': self.websocket.stats()}
+        if self.encoder.delta is not None:
+            metrics['frameBytes'] = self.encoder.stats()
+        if self.controller is not None:
+            metrics['quality'] = self.controller.metrics()
+        return metrics
 
     def check_trial_done(self):
         '''
@@ -138,7 +305,8 @@ class Trial():
         whole trial memory in self.record, uncomment the call to self.save_record()
         to write the record to file before closing.
         '''
-        print(f"{TAG} Ending trial...")
+        log.info('Ending trial...')
+        log.info('Trial metrics: %s', self.get_metrics())
         await self.websocket.sendData("DONE",{"message":"done"})
         self.play = False
 
@@ -147,29 +315,38 @@ class Trial():
         Reads messages sent from websocket, handles commands as priority then 
         actions. Logs entire message in self.nextEntry
         '''
-        print(f"{TAG} handle_message function has recieved: ", message)
+        hotlog.debug('handle_message', 'handle_message function has recieved: %s', message)
 
         if not self.userId and 'userId' in message:
             self.userId = message['userId']
 
-            self.websocket.setID(self.userId) # Important 
+            self.websocket.setID(self.userId, self.trialId) # Important 
 
             self.projectId = message['projectId']
 
-            print(f"{TAG} self.userID is now = ", self.userId)
-            print(f"{TAG} self.projectID is now = ", self.projectId)
-            
+            log.info('self.userID is now = %s', self.userId)
+            log.info('self.projectID is now = %s', self.projectId)
+            self.create_recorder()
+
             with open('./data/trialData.json') as json_file:
                 self.trialData = json.load(json_file)
             await self.send_ui()
 
+        if message.get('frameMode') in FRAME_MODES:
+            self.frameMode = message['frameMode']
+            log.info('Frame mode is now: %s', self.frameMode)
+
+        if message.get('batchMessages') is True and self.websocket.batchWindow > 0:
+            self.websocket.batchMessages = True
+            log.info('Batching control messages')
+
         if 'action' in message and message['action'] == 'command':
-            print(f'{TAG} commmand in message recieved.')
+            hotlog.debug('command', 'commmand in message recieved.')
             try:
                 #if message['KeyboardEvent']:
                 await self.handle_key_board_events(message['KeyboardEvent'])
             except:
-                print('got a different command')
+                hotlog.debug('command', 'got a different command')
                 await self.handle_command(message)
         # if 'KeyBoardEvent' in message and message['KeyboardEvent']:
         #     print(f'{TAG} commmand in message recieved.')
@@ -182,43 +359,73 @@ class Trial():
 
         elif 'save' in message and message['save']:
             self.nextEntry = message['save']
-            print(f"{TAG} saving data in self.nextEntry: ...",self.nextEntry)
-            self.save_data()
+            log.info('saving data in self.nextEntry: %s', hotlog.truncate(self.nextEntry))
+            self.record('save', data=self.nextEntry)
             self.done = True # if we recieve the save message, then trial is done for now, change later to conditional
         await self.check_done()
     
     
-    def save_data(self):
-        '''
-        Saving trial data can be used here, set s3 to true in config if you wish to use it,
-        otherwise look into websocket.saveData() method in websocket.py
-        '''
-
-        s3upload = self.config.get('s3upload')
-        fileName = f'{self.projectId}_{self.userId}.json'
-        if s3upload:
-            print(f"{TAG} S3 UPLOAD DETECTED... UPLOADING NOW....")
-            s3 = boto3.client('s3')
-            data_json = json.dumps(self.nextEntry)
-            # Convert the JSON string to bytes
-            data_bytes = data_json.encode('utf-8')
-            bucket = self.config.get('bucket')
-            # Upload the file to S3
-            try:
-                s3.put_object(Body=data_bytes, Bucket=bucket, Key=fileName)
-            except:
-                print(f"{TAG} S3 UPLOAD FAILED....")
-                
-        if not os.path.exists('Trials'):
-             os.makedirs('Trials')
-        
-        file_path = os.path.join('Trials', fileName)
-        with open(file_path, "w") as outfile:
-            json.dump(self.nextEntry, outfile, indent = 2)
+    def create_recorder(self):
+        '''
+        Events are appended to Trials/{projectId}_{userId}.jsonl as they
+        happen, save_data() compacts them into the .json file at the end.
+        '''
+        self.recorder = TrialRecorder(os.path.join('Trials', f'{self.projectId}_{self.userId}.jsonl'),
+            flushInterval=self.config.get('recordFlushInterval', 1),
+            fsyncInterval=self.config.get('recordFsyncInterval', 5))
+        self.record('start', trialId=self.trialId, modality=self.modality, game=self.config.get('game'))
+
+    def record(self, event, **data):
+        if self.recorder is not None:
+            self.recorder.record(event, **data)
+
+    async def save_data(self):
+        '''
+        Called once when the trial ends. Closes the event log and compacts it
+        into Trials/{projectId}_{userId}.json, and archives the transitions
+        the agent recorded (see archive_transitions). Both are also uploaded
+        in the background when s3upload is set in the config.
+        '''
+        if self.recorder is None:
+            return
+        recorder, self.recorder = self.recorder, None
+        await recorder.close()
+        log.info('Trial log: %s', recorder.stats())
+        fileName = os.path.join('Trials', f'{self.projectId}_{self.userId}.json')
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, lambda: compact(recorder.fileName, fileName,
+            trialId=self.trialId, projectId=self.projectId, userId=self.userId))
+        archive = await loop.run_in_executor(None, self.archive_transitions)
+
+        if self.uploader is not None:
+            await self.uploader.submit(fileName)
+            if archive is not None and archive.endswith('.npz'):
+                await self.uploader.submit(archive)
+            if self.ownsUploader:
+                await self.uploader.close(self.config.get('uploadTimeout', 60))
+
+    def archive_transitions(self):
+        '''
+        Writes the agent's TransitionBuffer to Trials/{projectId}_{userId}.npz,
+        or to the directory Trials/{projectId}_{userId}_episodes/ with
+        episodeArchive: npy, see episodeArchive.py.
+        Returns:
+            - path (Type: str, None if nothing was archived)
+        '''
+        archiveFormat = self.config.get('episodeArchive', 'npz')
+        transition = getattr(getattr(self, 'agent', None), 'transition', None)
+        if archiveFormat == 'none' or not isinstance(transition, TransitionBuffer) or not len(transition):
+            return None
+        name = f'{self.projectId}_{self.userId}'
+        path = os.path.join('Trials', name + '.npz' if archiveFormat == 'npz' else name + '_episodes')
+        metadata = save_archive(path, transition, {'trialId': self.trialId, 'projectId': self.projectId,
+            'userId': self.userId, 'game': self.config.get('game'), 'modality': self.modality})
+        log.info('Archived %s steps in %s episodes to %s', metadata['steps'], metadata['episodes'], path)
+        return path
 
     async def handle_key_board_events(self, message):
         #command = message['KeyboardEvent'].strip().lower()
-        print(f"{TAG} handle_key_board_event function: ", message)
+        hotlog.debug('keyboard', 'handle_key_board_event function: %s', message)
         key = list(message.keys())[0]
         value = message[key][0]
         self.handle_action(value)
@@ -230,26 +437,49 @@ class Trial():
         add commands.
         '''
         command = message['command'].strip().lower()
-        print(f"{TAG} handle_command function: ", command)
+        hotlog.debug('command', 'handle_command function: %s', command)
         if command == 'start':
                 self.play = True
+                self.pacer.reset()
                 if self.modality == 'pref':
                     if self.action == 'increase':
                         self.demo_idx+=1
                     elif self.action == 'decrease':
                         self.demo_idx-=1
-                    print(f'{TAG} Using demo: ', self.demo_idx)
+                    log.info('Using demo: %s', self.demo_idx)
+                    await self.render_policy()
 
         elif command == 'stop':
             await self.end()
         elif command == 'reset':
-            self.reset()
+            await self.reset()
         elif command == 'pause':
             self.play = False
+            if self.playback is not None:
+                self.playback.pause()
+        elif command == 'resume':
+            self.play = True
+            if self.playback is not None:
+                self.playback.resume()
+        elif command == 'seek':
+            # jump to, or while paused scrub to, a step of the playing demo
+            if self.playback is not None:
+                self.playback.seek(message.get('step', 0))
+        elif command == 'fpsup' or command == 'fpsdown':
+            if self.config.get('allowFrameRateChange'):
+                if command == 'fpsup':
+                    self.pacer.increase()
+                else:
+                    self.pacer.decrease()
+                if self.controller is not None:
+                    self.controller.set_target(self.pacer.framerate)
+                log.info('Frame rate is now: %s', self.pacer.framerate)
         elif command == 'requestUI':
-            self.send_ui()
+            await self.send_ui()
         elif command == 'good' or command == 'bad':
             self.handle_feedback(command)
+            if self.modality == 'feedback':
+                self.record('feedback', episode=self.episode, feedback=self.humanfeedback)
             self.handle_pref(command)
 
         elif command == 'left' or 'right' or 'up' or 'bad':
@@ -261,7 +491,7 @@ class Trial():
         Translates action to int and resets action buffer if action !=0
         '''
         #action = action.strip().lower()
-        print(f'{TAG} handle_action: ', action)
+        hotlog.debug('action', 'handle_action: %s', action)
         if self.modality == 'pref':
             if action == 'ArrowRight':
                 self.action = 'increase'
@@ -305,42 +535,69 @@ class Trial():
             self.human_pref = 'bad'
 
         self.nextEntry = {'preference':[self.demo_idx, self.human_pref]}
-        print(f"{TAG} self.nextEntry is now: ", self.nextEntry)
-        self.save_data()
+        log.info('self.nextEntry is now: %s', self.nextEntry)
+        self.record('preference', demo=self.demo_idx, preference=self.human_pref)
 
     async def get_render(self):
         '''
         Calls the Agent/Environment render function which must return a npArray.
-        Translates the npArray into a jpeg image and then base64 encodes the 
-        image for transmission in json message.
+        The npArray is encoded to jpeg bytes in the encoder pool, send_render()
+        picks the transport.
         '''
        
         # self.agent.reset()
         render = self.agent.render()
-        try:
-            img = Image.fromarray(render)
-            fp = BytesIO()
-            img.save(fp,'JPEG')
-            frame = base64.b64encode(fp.getvalue()).decode('utf-8')
-            fp.close()
-        except: 
-            raise TypeError("Render failed. Is env.render('rgb_array') being called\
-                            With the correct arguement?")
+        frame = await self.encoder.encode(render)
         self.frameId += 1
         return {'frame': frame, 'frameId': self.frameId}
+
+    def queue_render(self):
+        '''
+        Like get_render() but does not wait for the encoding, so the caller
+        can step the environment while the frame is encoded. Encoded frames
+        are sent by send_renders().
+        '''
+        render = self.agent.render()
+        self.frameId += 1
+        self.encoder.queue(self.frameId, render)
+
+    async def send_renders(self, flush=False):
+        for render in await self.encoder.collect(flush):
+            await self.send_render(render)
       
     async def send_ui(self):
         defaultUI = ['left','right','up','down','start','pause']
         try:
-            print( self.config.get('ui', defaultUI))
-            await self.websocket.sendData('UI', {'UI': self.config.get('ui', defaultUI)})
+            log.debug('Sending UI: %s', self.config.get('ui', defaultUI))
+            await self.websocket.sendData('UI', {
+                'UI': self.config.get('ui', defaultUI),
+                'frameModes': FRAME_MODES,
+                'frameFormat': self.encoder.frameFormat.lower(),
+                'batchMessages': self.websocket.batchWindow > 0})
             render = await self.get_render()
             await self.send_render(render)
         except:
             raise TypeError("Render Dictionary is not JSON serializable")
 
     async def send_render(self, render:dict):
-        await self.websocket.sendData('UI', {'env':render})
+        '''
+        Sends a frame in the negotiated frameMode: raw bytes behind a compact
+        binary header, or base64 inside the JSON 'UI' message. Delta frames
+        carry 'patches' to draw over the previous frame instead of 'frame'.
+        '''
+        frameFormat = self.encoder.frameFormat
+        if self.frameMode == 'binary':
+            if 'patches' in render:
+                await self.websocket.sendPatches(render['frameId'], render['patches'], frameFormat)
+            else:
+                await self.websocket.sendFrame(render['frameId'], render['frame'], frameFormat)
+        elif 'patches' in render:
+            patches = [{'x': x, 'y': y, 'frame': base64.b64encode(patch).decode('utf-8')}
+                       for x, y, patch in render['patches']]
+            await self.websocket.sendRender({'env': {'patches': patches, 'frameId': render['frameId']}}, keyframe=False)
+        else:
+            frame = base64.b64encode(render['frame']).decode('utf-8')
+            await self.websocket.sendRender({'env': {'frame': frame, 'frameId': render['frameId']}})
 
     async def take_step(self):
         '''
@@ -349,36 +606,63 @@ class Trial():
         Checks for DONE from Agent/Env
         '''
         if self.modality == 'feedback':
-            print('self.humanfeedback', self.humanfeedback)
+            hotlog.debug('step', 'self.humanfeedback %s', self.humanfeedback)
             done = self.agent.step(self.humanfeedback)
+            if self.recordSteps:
+                self.record('step', episode=self.episode, feedback=self.humanfeedback, done=bool(done))
+            self.humanfeedback = 'None' # feedback applies to a single step
 
         elif self.modality == 'demo':
-            print('self.humanAction', self.action)
+            hotlog.debug('step', 'self.humanAction %s', self.action)
             done = self.agent.step(self.action)
+            if self.recordSteps:
+                self.record('step', episode=self.episode, action=self.action, done=bool(done))
             
         if done:
-            self.reset()
+            await self.reset()
  
 
     async def render_policy(self):
-
-        
+        '''
+        Starts playing the current demo in its own task, cancelling the demo
+        that was playing, so commands keep being handled during playback. A
+        demo that was played before with the same game, seed and encoder
+        settings is streamed from the frame cache.
+        '''
+        await self.stop_playback()
         demo = self.agent.replay_buffer_of_demos[self.demo_idx]
-        print(f'{TAG} render_policy demo information: \n demo = {demo}, len of demo = {len(demo)}, demo number = {self.demo_idx}')
-        print(f'{TAG} resetting agent..')
-        self.agent.reset()
-        for idx, action in enumerate(demo):
-            print(demo)
-            print(f'idx {idx} out of {len(demo)}')
-            print(action)
-            done = self.agent.step(action)
-            render = await self.get_render()
-            await self.send_render(render)
-            time.sleep(1/self.framerate)
-            if done:
-                break
+        log.info('render_policy demo number = %s, len of demo = %s', self.demo_idx, len(demo))
+        log.debug('demo = %s', hotlog.truncate(demo))
+        self.playback = Playback(self.agent, demo, self.encoder, self.pacer, self.frameCache,
+                                 self.frame_cache_key(demo), self.config.get('snapshotInterval', 30))
+        self.playbackTask = asyncio.ensure_future(self.play_demo(self.playback))
+
+    async def play_demo(self, playback):
+        frames = playback.frames()
+        try:
+            async for render in frames:
+                self.frameId += 1
+                render['frameId'] = self.frameId
+                await self.send_render(render)
+        finally:
+            await frames.aclose()
         self.play = False
-        print(f'{TAG} self.play is now False')
+        log.debug('self.play is now False')
+
+    async def stop_playback(self):
+        if self.playbackTask is not None and not self.playbackTask.done():
+            self.playbackTask.cancel()
+            await asyncio.gather(self.playbackTask, return_exceptions=True)
+        self.playbackTask = None
+
+    def frame_cache_key(self, demo):
+        '''
+        Demos are only cached for agents that reset to a fixed seed.
+        '''
+        seed = getattr(self.agent, 'seed', None)
+        if self.frameCache is None or seed is None:
+            return None
+        return cache_key(self.config.get('game'), seed, self.demo_idx, demo, self.encoder)
 
 async def main():
     trial = Trial()
@@ -0,0 +1,213 @@
+'''
+Background upload of trial data, to S3 or, for tests and local runs, to a
+directory.
+A file submitted for upload is first linked (or copied) into a spool
+directory with a small JSON entry naming its key, so it survives a crash of
+the process. One worker task uploads the spooled files in the default
+executor with a single reused client, retrying failures with exponential
+backoff. An upload that keeps failing stays in the spool. Entries left in
+the spool by an earlier run are uploaded when the next Uploader starts.
+Entries are claimed by renaming them with the process id, so the workers
+of supervisor.py can share a spool directory.
+'''
+import asyncio
+import json
+import os
+import random
+import shutil
+import time
+import shortuuid
+from hippoLogging import get_logger
+
+log = get_logger('uploader')
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class S3Backend():
+    '''
+    Uploads with boto3's managed transfer, which switches to a multipart
+    upload for files larger than multipartMB. The client is created on first
+    use, and boto3 is only imported then.
+    '''
+
+    def __init__(self, bucket, multipartMB=8):
+        self.bucket = bucket
+        self.multipartBytes = multipartMB*1024*1024
+        self.client = None
+        self.transferConfig = None
+
+    def upload(self, fileName, key):
+        if self.client is None:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            self.client = boto3.client('s3')
+            self.transferConfig = TransferConfig(multipart_threshold=self.multipartBytes,
+                                                 multipart_chunksize=self.multipartBytes)
+        self.client.upload_file(fileName, self.bucket, key, Config=self.transferConfig)
+
+    def __repr__(self):
+        return f's3://{self.bucket}'
+
+class FileBackend():
+    '''
+    Copies uploads to root/key, a stand-in for S3 when testing or running
+    without AWS.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def upload(self, fileName, key):
+        target = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        tmp = f'{target}.{os.getpid()}.tmp'
+        shutil.copyfile(fileName, tmp)
+        os.replace(tmp, target)
+
+    def __repr__(self):
+        return self.root
+
+class Uploader():
+    '''
+    submit() spools a file and returns, the upload happens in the background.
+    start() (idempotent, needs the event loop) starts the worker and queues
+    what is left in the spool. close() gives queued uploads up to a timeout
+    to finish; whatever is not uploaded by then stays spooled.
+    '''
+
+    def __init__(self, backend, spool='Trials/spool', retries=5, backoff=1.0, maxBackoff=60):
+        self.backend = backend
+        self.spool = spool
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.queue = None
+        self.task = None
+        self.metrics = {'submitted': 0, 'uploaded': 0, 'retries': 0, 'failed': 0, 'bytes': 0, 'resumed': 0}
+        os.makedirs(spool, exist_ok=True)
+
+    def start(self):
+        if self.task is not None:
+            return
+        self.queue = asyncio.Queue()
+        for entry in self.claim_spooled():
+            self.queue.put_nowait(entry)
+            self.metrics['resumed'] += 1
+        if self.metrics['resumed']:
+            log.info('Uploading %s files left in %s', self.metrics['resumed'], self.spool)
+        self.task = asyncio.ensure_future(self.run())
+
+    def claim_spooled(self):
+        '''
+        Claims the spooled entries no running process owns.
+        Returns:
+            - entries (Type: list of entry ids)
+        '''
+        entries = []
+        claim = f'.json.{os.getpid()}'
+        for name in sorted(os.listdir(self.spool)):
+            if name.endswith('.json'):
+                entry = name[:-len('.json')]
+            elif '.json.' in name:
+                entry, pid = name.split('.json.', 1)
+                if not pid.isdigit() or (int(pid) != os.getpid() and process_alive(int(pid))):
+                    continue
+            else:
+                continue
+            try:
+                os.rename(os.path.join(self.spool, name), os.path.join(self.spool, entry + claim))
+            except FileNotFoundError:
+                continue # claimed by another process first
+            entries.append(entry)
+        return entries
+
+    def paths(self, entry):
+        return (os.path.join(self.spool, entry + '.data'),
+                os.path.join(self.spool, f'{entry}.json.{os.getpid()}'))
+
+    def spool_file(self, fileName, key):
+        entry = shortuuid.uuid()
+        data, meta = self.paths(entry)
+        try:
+            os.link(fileName, data)
+        except OSError:
+            shutil.copyfile(fileName, data)
+        tmp = f'{meta}.tmp'
+        with open(tmp, 'w') as outfile:
+            json.dump({'key': key, 'fileName': fileName, 'time': time.time()}, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        # the entry exists once its JSON does
+        os.replace(tmp, meta)
+        return entry
+
+    async def submit(self, fileName, key=None):
+        '''
+        Spools fileName for upload as key (its base name by default).
+        '''
+        self.start()
+        key = key or os.path.basename(fileName)
+        entry = await asyncio.get_running_loop().run_in_executor(None, self.spool_file, fileName, key)
+        self.metrics['submitted'] += 1
+        self.queue.put_nowait(entry)
+        log.info('Queued %s for upload to %s', key, self.backend)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self.queue.get()
+            try:
+                await self.upload(loop, entry)
+            finally:
+                self.queue.task_done()
+
+    async def upload(self, loop, entry):
+        data, meta = self.paths(entry)
+        try:
+            with open(meta) as infile:
+                key = json.load(infile)['key']
+        except (OSError, ValueError):
+            log.exception('Spool entry %s is unreadable, skipping it', entry)
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                await loop.run_in_executor(None, self.backend.upload, data, key)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    self.metrics['failed'] += 1
+                    log.error('Upload of %s failed %s times, left in %s: %s', key, attempt + 1, self.spool, e)
+                    return
+                delay = min(self.maxBackoff, self.backoff*2**attempt)*random.uniform(0.5, 1)
+                self.metrics['retries'] += 1
+                log.warning('Upload of %s failed (%s), retrying in %.1f s', key, e, delay)
+                await asyncio.sleep(delay)
+        self.metrics['uploaded'] += 1
+        self.metrics['bytes'] += os.path.getsize(data)
+        os.remove(meta)
+        os.remove(data)
+        log.info('Uploaded %s to %s', key, self.backend)
+
+    async def close(self, timeout=60):
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning('%s uploads not finished, left in %s', self.queue.qsize() + 1, self.spool)
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        log.info('Uploads: %s', self.stats())
+
+    def stats(self):
+        return dict(self.metrics, queued=self.queue.qsize() if self.queue is not None else 0)
@@ -1,69 +1,429 @@
 import json
+import random
+import struct
+import time
 import websockets
 import asyncio
 import os
+from collections import deque
+from itertools import groupby
+from hippoLogging import get_logger, HotPathLogger
+
+log = get_logger('websocket')
+hotlog = HotPathLogger(log)
 
 TAG = "\033[1;35m[HIPPOGYM]\033[0m" 
 
+'''
+Header of a binary frame message, followed by the userId (utf-8) and then
+the encoded image bytes:
+    version (uint8), frameFormat (uint8), frameId (uint32), userId length (uint16)
+Delta frames use version 2 and instead of the image carry a patch count
+(uint16) followed by, for each patch, x (uint16), y (uint16), length (uint32)
+and the encoded patch bytes.
+All fields are big-endian.
+'''
+FRAME_HEADER = struct.Struct('!BBIH')
+PATCH_COUNT = struct.Struct('!H')
+PATCH_HEADER = struct.Struct('!HHI')
+FRAME_VERSION = 1
+DELTA_FRAME_VERSION = 2
+FRAME_FORMAT_CODES = {'JPEG': 1, 'WEBP': 2}
+
 class Websocket:
+    '''
+    Connection to the API Gateway websocket. Connecting retries with
+    exponential backoff and jitter. Once connected an application level
+    heartbeat keeps the connection alive, and a dropped connection is
+    re-established transparently: the session is resumed by sending the
+    userId/trialId on resumeRouteKey, and messages sent while reconnecting
+    are held in a bounded outbox (oldest dropped first) and flushed after.
+
+    Outbound traffic is split in two. Once the frontend has agreed to
+    batching (batchMessages, see Trial.send_ui), control messages from
+    sendData are collected for batchWindow seconds (or maxBatchSize
+    messages) and consecutive messages with the same route key go out as
+    one message with a 'batch' list; until then each is sent on its own.
+    Frames go through a single slot drained by a sender
+    task, so when the link is backed up only the newest frame is sent.
+    '''
     
-    def __init__(self, connection_url = None):
+    def __init__(self, connection_url = None, maxRetries=5, baseDelay=0.5, maxDelay=30,
+                 heartbeatInterval=30, outboxSize=100, heartbeatRouteKey='heartbeat',
+                 resumeRouteKey='start', batchWindow=0.01, maxBatchSize=20, coalesceFrames=True):
         if connection_url is None:
             connection_url = 'wss://x4v1m0bphh.execute-api.ca-central-1.amazonaws.com/production?connection_type=backend'
         self.connection_url = connection_url
         self.websocket = None
         self.userID = None
+        self.trialID = None
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.heartbeatInterval = heartbeatInterval
+        self.heartbeatRouteKey = heartbeatRouteKey
+        self.resumeRouteKey = resumeRouteKey
+        self.outbox = deque(maxlen=outboxSize)
+        self.droppedMessages = 0
+        self.reconnects = 0
+        self.reconnecting = None
+        self.heartbeat = None
+        self.closing = False
+        self.batchWindow = batchWindow
+        self.maxBatchSize = maxBatchSize
+        self.batchMessages = False # set once the frontend accepts 'batch' messages
+        self.pending = []
+        self.pendingSince = 0
+        self.flushTimer = None
+        self.flushTasks = set()
+        self.flushLock = asyncio.Lock()
+        self.coalesceFrames = coalesceFrames
+        self.latestFrame = None
+        self.latestKeyframe = False # whether latestFrame is a keyframe
+        self.needKeyframe = False
+        self.frameReady = asyncio.Event()
+        self.sender = None
+        self.onFrameSent = None # called with the seconds a frame took to send
+        self.onFrameDropped = None # called when a delta frame had to be dropped
+        self.onReconnect = None # called once a dropped connection is re-established
+        self.metrics = {'batches': 0, 'batchedMessages': 0, 'batchLatency': 0.0,
+                        'framesSent': 0, 'framesCoalesced': 0}
 
-    def setID(self, userID):
+    def setID(self, userID, trialID=None):
         self.userID = userID
+        if trialID is not None:
+            self.trialID = trialID
 
-    async def connectClient(self):
-        retries = 0
-        while retries < 5:
+    def backoff(self, attempt):
+        '''
+        Exponential backoff with jitter, so many containers reconnecting after
+        the same outage do not retry in lockstep.
+        '''
+        return min(self.maxDelay, self.baseDelay*2**attempt)*random.uniform(0.5, 1)
+
+    async def open(self):
+        for attempt in range(self.maxRetries):
             try:
-                self.websocket = await websockets.connect(self.connection_url)
-                print(TAG, "Connected to WebSocket address")
-                break
+                return await websockets.connect(self.connection_url)
             except Exception as e:
-                print(f"Failed to connect: {e}")
-                retries += 1
-                await asyncio.sleep(1)  # wait a bit before retrying
+                delay = self.backoff(attempt)
+                log.warning('Failed to connect: %s, retrying in %.1fs', e, delay)
+                await asyncio.sleep(delay)
+        return None
 
+    async def connectClient(self):
+        self.closing = False
+        self.websocket = await self.open()
+        if self.websocket is not None:
+            log.info('Connected to WebSocket address')
+            if self.heartbeatInterval and self.heartbeat is None:
+                self.heartbeat = asyncio.ensure_future(self.send_heartbeats())
+
+    async def reconnect(self):
+        '''
+        Re-opens a dropped connection. Concurrent callers share one attempt.
+        Returns:
+            - connected (Type: bool)
+        '''
+        if self.reconnecting is None:
+            self.reconnecting = asyncio.ensure_future(self._reconnect())
+        try:
+            return await asyncio.shield(self.reconnecting)
+        finally:
+            if self.reconnecting is not None and self.reconnecting.done():
+                self.reconnecting = None
+
+    async def _reconnect(self):
+        log.warning('WebSocket connection lost, reconnecting...')
+        self.websocket = None
+        websocket = await self.open()
+        if websocket is None:
+            log.error('Could not reconnect to WebSocket')
+            return False
+        self.reconnects += 1
+        try:
+            if self.userID is not None:
+                resume = {"action": self.resumeRouteKey, "userId": self.userID,
+                          "trialId": self.trialID, "resume": True}
+                await websocket.send(json.dumps(resume))
+            log.info('Reconnected, resending %s buffered messages', len(self.outbox))
+            while self.outbox:
+                await websocket.send(self.outbox[0])
+                self.outbox.popleft()
+        except websockets.ConnectionClosed:
+            log.warning('WebSocket closed again while resuming')
+            return False
+        self.websocket = websocket
+        # the outbox may have dropped the keyframe buffered deltas depend on
+        self.request_keyframe()
+        if self.onReconnect is not None:
+            self.onReconnect()
+        return True
+
+    def is_reconnecting(self):
+        return self.reconnecting is not None and not self.reconnecting.done()
+
+    async def send(self, message):
+        '''
+        Sends a str or bytes message, buffering it and reconnecting if the
+        connection has dropped.
+        '''
+        if self.websocket is None or self.is_reconnecting():
+            self.buffer(message)
+            return
+        try:
+            await self.websocket.send(message)
+        except websockets.ConnectionClosed:
+            if self.closing:
+                return
+            self.buffer(message)
+            await self.reconnect()
+
+    def buffer(self, message):
+        if len(self.outbox) == self.outbox.maxlen:
+            self.droppedMessages += 1
+        self.outbox.append(message)
+
+    async def send_heartbeats(self):
+        while not self.closing:
+            await asyncio.sleep(self.heartbeatInterval)
+            if self.websocket is not None and not self.is_reconnecting():
+                await self.send(json.dumps({"action": self.heartbeatRouteKey, "userId": self.userID,
+                                            "trialId": self.trialID, "time": time.time()}))
 
     async def sendData(self, routeKey, data):
-        if self.websocket is not None:
+        if self.websocket is not None or self.is_reconnecting():
             action_data = {"action": routeKey, "userId": self.userID, "sendTo" : "frontend" } 
             action_data.update(data)
-            print(TAG, "Sending to websocket...", action_data)
-            await self.websocket.send(json.dumps(action_data))
+            hotlog.debug(routeKey, 'Sending to websocket... %s', action_data)
+            if self.batchMessages and self.batchWindow > 0:
+                self.queue_message(action_data)
+            else:
+                await self.send(json.dumps(action_data))
+
+    def queue_message(self, action_data):
+        if not self.pending:
+            self.pendingSince = time.monotonic()
+            loop = asyncio.get_running_loop()
+            self.flushTimer = loop.call_later(self.batchWindow, self.schedule_flush)
+        self.pending.append(action_data)
+        if len(self.pending) >= self.maxBatchSize:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self.flushTasks.add(task)
+        task.add_done_callback(self.flush_done)
+
+    def flush_done(self, task):
+        self.flushTasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Failed to send batched messages', exc_info=task.exception())
+
+    async def flush(self):
+        '''
+        Sends the queued control messages, one message per run of messages
+        with the same route key. A run of one is sent unchanged.
+        '''
+        if self.flushTimer is not None:
+            self.flushTimer.cancel()
+            self.flushTimer = None
+        if not self.pending:
+            return
+        messages, self.pending = self.pending, []
+        self.metrics['batches'] += 1
+        self.metrics['batchedMessages'] += len(messages)
+        self.metrics['batchLatency'] += time.monotonic() - self.pendingSince
+        async with self.flushLock:
+            for routeKey, group in groupby(messages, key=lambda message: message['action']):
+                group = list(group)
+                if len(group) == 1:
+                    await self.send(json.dumps(group[0]))
+                else:
+                    await self.send(json.dumps({"action": routeKey, "userId": self.userID,
+                                                "sendTo": "frontend", "batch": group}))
+
+    async def sendRender(self, data, keyframe=True):
+        '''
+        Sends a JSON frame message, e.g. {'env': {...}}, through the frame slot.
+        '''
+        if self.websocket is not None or self.is_reconnecting():
+            action_data = {"action": "UI", "userId": self.userID, "sendTo" : "frontend" }
+            action_data.update(data)
+            await self.queue_frame(json.dumps(action_data), keyframe)
+
+    async def queue_frame(self, message, keyframe=True):
+        '''
+        Puts a frame in the send slot, replacing a frame that has not been
+        sent yet. A delta frame can only follow the frame it was computed
+        against, so when one cannot be sent in order it is dropped and
+        deltas are skipped until the next keyframe (see onFrameDropped).
+        '''
+        if not self.coalesceFrames:
+            await self.flush()
+            await self.send_frame(message)
+            return
+        if self.sender is None:
+            self.sender = asyncio.ensure_future(self.send_frames())
+            self.sender.add_done_callback(self.sender_done)
+        if not keyframe and (self.latestFrame is not None or self.needKeyframe):
+            self.metrics['framesCoalesced'] += 1
+            if not self.needKeyframe:
+                self.needKeyframe = True
+                if self.onFrameDropped is not None:
+                    self.onFrameDropped()
+            return
+        if self.latestFrame is not None:
+            self.metrics['framesCoalesced'] += 1
+        if keyframe:
+            self.needKeyframe = False
+        self.latestFrame = message
+        self.latestKeyframe = keyframe
+        self.frameReady.set()
+
+    def request_keyframe(self):
+        '''
+        Drops the delta frame waiting to be sent, if any, skips deltas until
+        the next keyframe and asks for one through onFrameDropped.
+        '''
+        if self.latestFrame is not None and not self.latestKeyframe:
+            self.latestFrame = None
+            self.metrics['framesCoalesced'] += 1
+        self.needKeyframe = True
+        if self.onFrameDropped is not None:
+            self.onFrameDropped()
+
+    async def send_frames(self):
+        while not self.closing:
+            await self.frameReady.wait()
+            self.frameReady.clear()
+            if self.is_reconnecting():
+                try:
+                    await asyncio.shield(self.reconnecting)
+                except Exception:
+                    pass
+            message, self.latestFrame = self.latestFrame, None
+            if message is not None:
+                try:
+                    await self.flush()
+                    await self.send_frame(message)
+                except Exception:
+                    # one frame is lost, the sender keeps going
+                    log.exception('Failed to send frame')
+
+    def sender_done(self, task):
+        # the next queue_frame starts a new sender if this one died
+        if self.sender is task:
+            self.sender = None
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Frame sender stopped', exc_info=task.exception())
+
+    async def send_frame(self, message):
+        start = time.monotonic()
+        await self.send(message)
+        self.metrics['framesSent'] += 1
+        if self.onFrameSent is not None:
+            self.onFrameSent(time.monotonic() - start)
+
+    def stats(self):
+        batches = self.metrics['batches']
+        return {
+            'batches': batches,
+            'averageBatchSize': round(self.metrics['batchedMessages']/batches, 2) if batches else 0,
+            'averageBatchLatencyMs': round(self.metrics['batchLatency']*1000/batches, 2) if batches else 0,
+            'framesSent': self.metrics['framesSent'],
+            'framesCoalesced': self.metrics['framesCoalesced'],
+            'reconnects': self.reconnects,
+            'droppedMessages': self.droppedMessages,
+        }
+
+    async def sendFrame(self, frameId, frame, frameFormat='JPEG'):
+        '''
+        Sends an encoded frame as a single binary message instead of a
+        base64 string inside JSON. See FRAME_HEADER for the layout.
+        '''
+        if self.websocket is not None or self.is_reconnecting():
+            userID = (self.userID or '').encode('utf-8')
+            header = FRAME_HEADER.pack(FRAME_VERSION, FRAME_FORMAT_CODES[frameFormat],
+                                       frameId & 0xFFFFFFFF, len(userID))
+            await self.queue_frame(header + userID + frame)
+
+    async def sendPatches(self, frameId, patches, frameFormat='JPEG'):
+        '''
+        Sends a delta frame, a list of (x, y, bytes) patches to draw over the
+        previous frame, as a single binary message.
+        '''
+        if self.websocket is not None or self.is_reconnecting():
+            userID = (self.userID or '').encode('utf-8')
+            parts = [FRAME_HEADER.pack(DELTA_FRAME_VERSION, FRAME_FORMAT_CODES[frameFormat],
+                                       frameId & 0xFFFFFFFF, len(userID)),
+                     userID, PATCH_COUNT.pack(len(patches))]
+            for x, y, patch in patches:
+                parts.append(PATCH_HEADER.pack(x, y, len(patch)))
+                parts.append(patch)
+            await self.queue_frame(b''.join(parts), keyframe=False)
             
     async def recieveData(self):
-        if self.websocket is not None:
-            message = await self.websocket.recv()
+        '''
+        Waits for the next message, reconnecting if the connection drops.
+        Raises ConnectionError if the connection cannot be re-established.
+        '''
+        while True:
+            if self.websocket is None and not await self.reconnect():
+                raise ConnectionError('WebSocket connection lost')
+            try:
+                message = await self.websocket.recv()
+                break
+            except websockets.ConnectionClosed:
+                if self.closing:
+                    raise
+                if not await self.reconnect():
+                    raise ConnectionError('WebSocket connection lost')
         try:
             message = json.loads(message)
-            print(TAG, "Message from websocket reads: ", message)
+            hotlog.debug('recieve', 'Message from websocket reads: %s', message)
         except:
             message = {'error': 'unable to parse message from websocket'}
         return message
     
     async def saveData(self, fileName, data, fileExt=None):
-
+        '''
+        One-off export of data to Trials/, written in the default executor.
+        fileExt 'csv' writes real CSV, see episodeArchive.write_csv() for the
+        shapes of data it accepts, anything else writes JSON.
+        Events that happen during a trial belong in the trial's append-only
+        log instead, see recorder.py.
+        '''
         if not os.path.exists('Trials'):
             os.makedirs('Trials')
-        if fileExt is None:
-            fileExt = '.json'
+        fileExt = (fileExt or 'json').lstrip('.').lower()
         fileName = fileName + "." + fileExt
 
         file_path = os.path.join('Trials', fileName)
-        with open(file_path, "w") as outfile:
-            json.dump(data, outfile, indent=2)
+        def write():
+            if fileExt == 'csv':
+                from episodeArchive import write_csv
+                write_csv(file_path, data)
+                return
+            with open(file_path, "w") as outfile:
+                json.dump(data, outfile, separators=(',', ':'))
+        await asyncio.get_running_loop().run_in_executor(None, write)
 
         
 
 
     async def disconnectClient(self):
+        await self.flush()
+        if self.flushTasks:
+            await asyncio.gather(*self.flushTasks, return_exceptions=True)
+        self.closing = True
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        if self.sender is not None:
+            self.sender.cancel()
+            self.sender = None
         if self.websocket is not None:
-            print(f"{TAG} Disconnecting from WebSocket...")
+            log.info('Disconnecting from WebSocket...')
             await self.websocket.close()
     
\ No newline at end of file